@@ -1,22 +1,56 @@
+import io
 import os
 import time
 import uuid
+import struct
+import hashlib
 import functools
-from threading import Thread
+from collections import namedtuple, deque
+from threading import Thread, Lock, Event, Condition
 from glob import glob
+from werkzeug.exceptions import HTTPException
 from flask import Flask, url_for, jsonify, send_file, make_response, \
     copy_current_request_context, Response, request
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     # This will only work on a Raspberry Pi
     import picamera
 except:
     picamera = None
 
+try:
+    # gevent is only needed for the asynchronous serving mode
+    import gevent
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    gevent = None
+
 cameras = {}  # available cameras
 background_tasks = {}
+streaming_routes = set()  # endpoints that return long lived streams
 app = Flask(__name__)
 app.config['AUTO_DELETE_BG_TASKS'] = False
+app.config['PACKED_TIMELAPSES'] = False
+app.config['CAMERA_IDLE_TIMEOUT'] = 60  # seconds before closing a camera
+app.config['CAMERA_JOB_TIMEOUT'] = 60  # seconds a capture can take
+app.config['FAKE_CAMERA_WARMUP'] = 2  # emulated warm up time in seconds
+app.config['LIVE_FPS'] = 10  # frame rate of live broadcasts
+app.config['ASYNC_THREADS'] = 4  # worker threads in asynchronous mode
+app.config['LOADER_THREADS'] = 4  # threads that read time lapse frames
+app.config['MAX_BURST'] = 100  # photos allowed in a burst
+app.config['CAPTURE_CONCURRENCY'] = {'pi': 1}  # captures at a time
+app.config['CAPTURE_QUEUE_SIZE'] = 8  # captures allowed to wait
+app.config['CAPTURE_TIMEOUT'] = 10  # seconds a capture can wait
+app.config['CAPTURE_RETRY_AFTER'] = 5  # seconds, sent to busy clients
+app.config['STORAGE_QUOTA'] = {}  # bytes allowed per camera id
+app.config['STORAGE_MAX_AGE'] = {}  # seconds to keep photos per camera id
+app.config['RETENTION_INTERVAL'] = 60  # seconds between retention passes
 
 
 # custom exceptions
@@ -26,6 +60,9 @@ class InvalidCamera(ValueError):
 class InvalidPhoto(ValueError):
     pass
 
+class CameraBusy(RuntimeError):
+    pass
+
 # custom error handlers
 @app.errorhandler(InvalidCamera)
 def invalid_camera(e):
@@ -35,6 +72,11 @@ def invalid_camera(e):
 def invalid_photo(e):
     return jsonify({'error': 'photo not found'}), 404
 
+@app.errorhandler(CameraBusy)
+def camera_busy(e):
+    return jsonify({'error': 'camera busy'}), 503, \
+        {'Retry-After': str(app.config['CAPTURE_RETRY_AFTER'])}
+
 @app.errorhandler(400)
 def bad_request(e=None):
     return jsonify({'error': 'bad request'}), 400
@@ -65,10 +107,644 @@ def get_camera_from_id(camid):
     return camera
 
 
+def write_file(path, data):
+    """Write a file atomically, through a temporary file."""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+
+class BlobStore(object):
+    """Content addressed storage for photos. Each distinct jpeg is stored
+    once, under the SHA1 hash of its contents, and photos are hard links to
+    their blob. The link count of a blob is then its reference count."""
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.hashes = None  # maps blob inode numbers to hashes
+        self.hard_links = True  # cleared if the filesystem has no links
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def load(self):
+        """Build the inode to hash map from the blobs on disk. This only
+        needs to stat the blobs, the photos themselves are never read."""
+        if self.hashes is None:
+            self.hashes = {}
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    self.hashes[os.stat(path).st_ino] = filename
+
+    def store(self, data, path):
+        """Write a photo, reusing the blob of an identical photo if there is
+        one. Returns the hash of the photo, or None if the filesystem does
+        not support hard links and the photo was written as a plain file."""
+        if not self.hard_links:
+            write_file(path, data)
+            return None
+        digest = hashlib.sha1(data).hexdigest()
+        blob_path = self.get_blob_path(digest)
+        with self.lock:
+            self.load()
+            created = False
+            if not os.path.exists(blob_path):
+                if not os.path.exists(os.path.dirname(blob_path)):
+                    os.makedirs(os.path.dirname(blob_path))
+                write_file(blob_path, data)
+                self.hashes[os.stat(blob_path).st_ino] = digest
+                created = True
+            try:
+                os.link(blob_path, path)
+            except OSError:
+                # without hard links photos cannot share a blob, or be
+                # reference counted, so they are stored as plain files
+                self.hard_links = False
+                if created:
+                    del self.hashes[os.stat(blob_path).st_ino]
+                    os.remove(blob_path)
+        if not self.hard_links:
+            write_file(path, data)
+            return None
+        return digest
+
+    def get_hash(self, path):
+        """Return the hash of a photo, or None if the photo is not linked to
+        a blob."""
+        with self.lock:
+            self.load()
+            return self.hashes.get(os.stat(path).st_ino)
+
+    def remove(self, path):
+        """Remove a photo. The blob is also removed when this photo was its
+        last reference. Returns the number of bytes freed."""
+        return self.remove_many([path])
+
+    def remove_many(self, paths):
+        """Remove a batch of photos under a single acquisition of the lock.
+        Returns the number of bytes freed."""
+        freed = 0
+        with self.lock:
+            self.load()
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                    os.remove(path)
+                except OSError:
+                    # already deleted, the rest of the batch still goes
+                    continue
+                digest = self.hashes.get(st.st_ino)
+                if digest is None:
+                    freed += st.st_size
+                elif st.st_nlink <= 2:  # the blob and this photo
+                    try:
+                        os.remove(self.get_blob_path(digest))
+                    except OSError:
+                        pass
+                    del self.hashes[st.st_ino]
+                    freed += st.st_size
+        return freed
+
+
+class FrameLoader(object):
+    """A jpeg frame that is loaded by a loader pool, so that it can be read
+    ahead while the previous frame is being sent to the client."""
+    def __init__(self, load, n):
+        self.load = load
+        self.n = n
+        self.done = Event()
+        self.frame = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.frame = self.load(self.n)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def get(self):
+        """Wait for the frame to be loaded and return it."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.frame
+
+
+class LoaderPool(object):
+    """Small pool of threads that load frames for all the streams. Threads
+    are started as they are needed, up to the size of the pool, and are
+    reused for the lifetime of the process."""
+    def __init__(self, size):
+        self.size = size
+        self.loaders = queue.Queue()
+        self.threads = []
+        self.lock = Lock()
+
+    def load(self, f, n):
+        loader = FrameLoader(f, n)
+        with self.lock:
+            if len(self.threads) < self.size:
+                thread = Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.loaders.put(loader)
+        return loader
+
+    def run(self):
+        while True:
+            self.loaders.get().run()
+
+
+class StreamScheduler(object):
+    """Blocking operations used by the streaming routes. This implementation
+    blocks the calling thread, so each stream occupies a worker thread for as
+    long as it runs."""
+    def __init__(self):
+        self.pool = None
+        self.lock = Lock()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def load(self, f, n):
+        """Start loading a frame in the background. The returned object has
+        a get() method that returns the frame."""
+        with self.lock:
+            if self.pool is None:
+                self.pool = LoaderPool(app.config['LOADER_THREADS'])
+        return self.pool.load(f, n)
+
+    def wait_frame(self, broadcast, seq):
+        return broadcast.get_frame(seq)
+
+
+class CooperativeStreamScheduler(StreamScheduler):
+    """Blocking operations used by the streaming routes when running under
+    gevent. Waits yield to other streams instead of blocking, so any number
+    of streams can share a single thread."""
+    def __init__(self, pool, poll_interval=0.01):
+        self.pool = pool
+        self.poll_interval = poll_interval
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def load(self, f, n):
+        # file reads cannot be made cooperative, so they go to the pool
+        return self.pool.spawn(f, n)
+
+    def wait_frame(self, broadcast, seq):
+        # the broadcast is fed by a real thread, so instead of waiting on its
+        # condition variable the stream checks for new frames periodically
+        while not broadcast.has_frame(seq):
+            gevent.sleep(self.poll_interval)
+        return broadcast.get_frame(seq)
+
+scheduler = StreamScheduler()
+
+
+class FileTimelapse(object):
+    """Time lapse stored as a jpeg file per frame, with names that follow the
+    <uuid>_<frame>_<count>.jpg format."""
+    def __init__(self, path, store):
+        try:
+            parts = path.split('.')[0].split('_')
+            self.count = int(parts[2])
+        except (IndexError, ValueError):
+            raise InvalidPhoto()
+        self.template = parts[0] + '_{0:03d}_{1:03d}.jpg'
+        self.store = store
+
+    def get_frame_path(self, n):
+        if n < 0 or n >= self.count:
+            raise InvalidPhoto()
+        return self.template.format(n, self.count)
+
+    def get_frame(self, n):
+        with open(self.get_frame_path(n), 'rb') as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+    def delete(self):
+        self.store.remove_many([self.get_frame_path(i)
+                                for i in range(self.count)])
+
+
+class PackedTimelapse(object):
+    """Time lapse stored as a single append-only file with all the jpeg
+    frames, plus an index file with the end offset of each frame. Any frame
+    can be located with a single seek into the index."""
+    extension = '.mjpeg'
+    offset_format = '<Q'
+    offset_size = struct.calcsize(offset_format)
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '.idx'
+        try:
+            self.file = open(self.path, 'rb')
+        except IOError:
+            raise InvalidPhoto()
+        try:
+            self.index = open(self.index_path, 'rb')
+        except IOError:
+            self.file.close()
+            raise InvalidPhoto()
+        self.count = os.fstat(self.index.fileno()).st_size // \
+            self.offset_size
+
+    def get_frame(self, n):
+        if n < 0 or n >= self.count:
+            raise InvalidPhoto()
+        # the entries of frames n - 1 and n have the start and end offsets
+        if n == 0:
+            start = 0
+            self.index.seek(0)
+            data = self.index.read(self.offset_size)
+        else:
+            self.index.seek((n - 1) * self.offset_size)
+            data = self.index.read(2 * self.offset_size)
+            start = struct.unpack_from(self.offset_format, data)[0]
+            data = data[self.offset_size:]
+        end = struct.unpack(self.offset_format, data)[0]
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def delete(self):
+        # renaming the data file makes the time lapse disappear in a single
+        # atomic step, after that the files can be removed at leisure
+        self.close()
+        deleted_path = self.path + '.deleted'
+        os.rename(self.path, deleted_path)
+        os.remove(self.index_path)
+        os.remove(deleted_path)
+
+    @classmethod
+    def create(cls, path):
+        """Return a writer that appends frames to a new packed time lapse."""
+        return PackedTimelapseWriter(path, os.path.splitext(path)[0] + '.idx',
+                                     cls.offset_format)
+
+
+class PackedTimelapseWriter(object):
+    """Append frames to a packed time lapse. The frame data is written before
+    its index entry, so readers never see a partially written frame."""
+    def __init__(self, path, index_path, offset_format):
+        self.file = open(path, 'ab')
+        self.index = open(index_path, 'ab')
+        self.offset_format = offset_format
+
+    def append(self, frame):
+        self.file.write(frame)
+        self.file.flush()
+        self.index.write(struct.pack(self.offset_format, self.file.tell()))
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CaptureJob(object):
+    """A function to run with the camera device, and its outcome."""
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.done = Event()
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def run(self, device):
+        try:
+            self.result = self.f(device, *self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to run and return its result. A job that does
+        not finish within the timeout is cancelled, and raises
+        CameraBusy."""
+        if not self.done.wait(timeout):
+            self.cancelled = True
+            raise CameraBusy()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CameraSession(Thread):
+    """Long lived session with a camera device. A dedicated thread owns the
+    device and runs capture jobs from a queue one at a time, so concurrent
+    requests never use the device at the same time. The device is opened and
+    warmed up when the first job arrives, and is closed after it has been
+    idle for CAMERA_IDLE_TIMEOUT seconds."""
+    def __init__(self, camera):
+        super(CameraSession, self).__init__()
+        self.daemon = True
+        self.camera = camera
+        self.device = None
+        self.jobs = queue.Queue()
+        self.start()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.device is not None:
+                timeout = app.config['CAMERA_IDLE_TIMEOUT']
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                self.close()
+                continue
+            if job is None:
+                self.close()
+                return
+            if job.cancelled:
+                continue
+            try:
+                if self.device is None:
+                    self.device = self.camera.open_device()
+            except Exception as e:
+                job.error = e
+                job.done.set()
+                continue
+            job.run(self.device)
+            if job.error is not None:
+                # the device may be in a bad state, so start over with a new
+                # one on the next job
+                self.close()
+
+    def close(self):
+        """Close the device. Errors are logged, the session thread needs to
+        keep running so that it can open a new device for the next job."""
+        if self.device is not None:
+            try:
+                self.camera.close_device(self.device)
+            except Exception:
+                app.logger.exception('Could not close the camera device')
+            finally:
+                self.device = None
+
+    def execute(self, f, *args):
+        """Run f(device, *args) in the session thread and return its
+        result. Raises CameraBusy if the job does not finish within
+        CAMERA_JOB_TIMEOUT seconds."""
+        job = CaptureJob(f, args)
+        self.jobs.put(job)
+        return job.wait(app.config['CAMERA_JOB_TIMEOUT'])
+
+    def stop(self):
+        """End the session after the jobs already queued, closing the
+        device. Waits for the session thread to exit."""
+        self.jobs.put(None)
+        self.join()
+
+
+class Broadcast(object):
+    """Live feed of a camera, shared by all its viewers. While there are
+    subscribers a single thread captures frames into a ring buffer, and each
+    subscriber reads frames from it at its own pace. A subscriber that falls
+    behind by more than the size of the buffer skips to the newest frame, so
+    slow clients drop frames instead of queueing them. The capture thread
+    exits when the last subscriber leaves."""
+    def __init__(self, camera, size=4):
+        self.camera = camera
+        self.frames = [None] * size
+        self.seq = 0  # sequence number of the newest frame
+        self.subscribers = 0
+        self.thread = None
+        self.cond = Condition()
+
+    def subscribe(self):
+        """Register a subscriber, starting the capture thread if needed.
+        Returns the sequence number to pass to the first get_frame call."""
+        with self.cond:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            return self.seq
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def run(self):
+        interval = 1.0 / app.config['LIVE_FPS']
+        next_time = time.time()
+        while True:
+            with self.cond:
+                if self.subscribers == 0:
+                    self.thread = None
+                    return
+            try:
+                frame = self.camera.session.execute(self.camera.capture_frame)
+            except Exception:
+                frame = None
+            with self.cond:
+                self.seq += 1
+                self.frames[self.seq % len(self.frames)] = frame
+                self.cond.notify_all()
+                if frame is None:
+                    # a capture error ends the broadcast for all subscribers
+                    self.thread = None
+                    return
+            next_time += interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()
+
+    def has_frame(self, seq):
+        """Check if get_frame can return without waiting."""
+        return self.seq > seq or self.thread is None
+
+    def get_frame(self, seq):
+        """Wait for the frame that follows the given sequence number.
+        Returns the sequence number of the frame and the frame, which is
+        None if the broadcast has ended."""
+        with self.cond:
+            while self.seq <= seq:
+                if self.thread is None:
+                    return seq, None
+                self.cond.wait()
+            if self.seq - seq > len(self.frames):
+                seq = self.seq  # too far behind, skip to the newest frame
+            else:
+                seq += 1
+            return seq, self.frames[seq % len(self.frames)]
+
+
+StorageGroup = namedtuple('StorageGroup',
+                          'name timelapse packed mtime size paths')
+
+
+class RetentionReaper(Thread):
+    """Background service that enforces the storage policies of the cameras
+    every RETENTION_INTERVAL seconds. Photos older than the camera's entry
+    in STORAGE_MAX_AGE are deleted, and if the camera is still above its
+    STORAGE_QUOTA the oldest time lapses and then the oldest photos are
+    deleted until it is back under quota."""
+    def __init__(self):
+        super(RetentionReaper, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            for camera in list(cameras.values()):
+                try:
+                    camera.enforce_retention(
+                        app.config['STORAGE_QUOTA'].get(camera.camid),
+                        app.config['STORAGE_MAX_AGE'].get(camera.camid))
+                except Exception:
+                    # retention will be attempted again on the next pass
+                    pass
+            time.sleep(app.config['RETENTION_INTERVAL'])
+
+
+class PhotoWriter(Thread):
+    """Write the photos of a burst in a background thread, so that the
+    camera can capture the next frame while the previous one is written."""
+    def __init__(self, camera, filenames):
+        super(PhotoWriter, self).__init__()
+        self.daemon = True
+        self.camera = camera
+        self.filenames = filenames
+        self.frames = queue.Queue()
+        self.written = []
+        self.error = None
+        self.start()
+
+    def run(self):
+        for filename in self.filenames:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                self.camera.save_photo(filename, frame)
+                self.written.append(filename)
+            except Exception as e:
+                self.error = e
+
+    def write(self, frame):
+        self.frames.put(frame)
+
+    def close(self):
+        """Wait for all the frames to be written. Returns the filenames of
+        the photos that were written."""
+        self.frames.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+
+class CaptureTicket(object):
+    """A place in the queue of a capture scheduler. The capture runs inside
+    a with statement on the ticket, which waits for the ticket's turn."""
+    def __init__(self, scheduler, timeout):
+        self.scheduler = scheduler
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.scheduler.acquire(self)
+        return self
+
+    def __exit__(self, *args):
+        self.scheduler.release()
+
+
+class CaptureScheduler(object):
+    """Admission control for the captures of a camera. Up to the camera's
+    CAPTURE_CONCURRENCY captures run at a time, and up to CAPTURE_QUEUE_SIZE
+    more wait for their turn in the order they arrived, for at most
+    CAPTURE_TIMEOUT seconds. Captures that do not fit in the queue or that
+    time out raise CameraBusy."""
+    def __init__(self, camid):
+        self.camid = camid
+        self.running = 0
+        self.waiting = deque()
+        self.cond = Condition()
+
+    def get_concurrency(self):
+        return app.config['CAPTURE_CONCURRENCY'].get(self.camid, 1)
+
+    def reserve(self, wait=False):
+        """Take a place at the end of the queue. A full queue raises
+        CameraBusy, unless wait is True, in which case the ticket is
+        queued anyway and waits without a timeout."""
+        with self.cond:
+            size = app.config['CAPTURE_QUEUE_SIZE'] + \
+                self.get_concurrency() - self.running
+            if not wait and len(self.waiting) >= size:
+                raise CameraBusy()
+            ticket = CaptureTicket(
+                self, None if wait else app.config['CAPTURE_TIMEOUT'])
+            self.waiting.append(ticket)
+            return ticket
+
+    def acquire(self, ticket):
+        """Wait until the ticket is first in line and a slot is free."""
+        deadline = None
+        if ticket.timeout is not None:
+            deadline = time.time() + ticket.timeout
+        with self.cond:
+            while self.waiting[0] is not ticket or \
+                    self.running >= self.get_concurrency():
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        self.waiting.remove(ticket)
+                        self.cond.notify_all()
+                        raise CameraBusy()
+                self.cond.wait(timeout)
+            self.waiting.popleft()
+            self.running += 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    def cancel(self, ticket):
+        """Give up a ticket that was reserved but is not going to be used."""
+        with self.cond:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+
 class BaseCamera(object):
     """Base camera handler class."""
     def __init__(self):
         self.camid = None  # to be defined by subclasses
+        self.store = None
+        self.session = None
+        self.scheduler = None
+        self.broadcast = Broadcast(self)
+        self.usage = None  # storage usage from the last scan
+        self.capturing = set()  # names of time lapses being captured
 
     def get_url(self):
         return url_for('get_camera', camid=self.camid, _external=True)
@@ -77,6 +753,8 @@ class BaseCamera(object):
         return {'self_url': self.get_url(),
                 'photos_url': self.get_photos_url(),
                 'timelapses_url': self.get_timelapses_url(),
+                'live_url': self.get_live_url(),
+                'storage': self.get_storage_usage(),
                 'emulated': self.is_emulated()}
 
     def get_photos_url(self):
@@ -85,6 +763,9 @@ class BaseCamera(object):
     def get_timelapses_url(self):
         return url_for('capture_timelapse', camid=self.camid, _external=True)
 
+    def get_live_url(self):
+        return url_for('get_live', camid=self.camid, _external=True)
+
     def get_photos(self):
         return [os.path.basename(f) for f in glob(self.camid + '/*.jpg')]
 
@@ -94,8 +775,195 @@ class BaseCamera(object):
             raise InvalidPhoto()
         return path
 
-    def get_new_photo_filename(self, suffix=''):
-        return uuid.uuid4().hex + suffix + '.jpg'
+    def get_new_photo_filename(self, suffix='', extension='.jpg'):
+        return uuid.uuid4().hex + suffix + extension
+
+    def get_timelapse(self, filename):
+        """Return the time lapse object for the given filename."""
+        path = self.get_photo_path(filename)
+        if filename.endswith(PackedTimelapse.extension):
+            return PackedTimelapse(path)
+        return FileTimelapse(path, self.store)
+
+    def save_photo(self, filename, data):
+        """Write a photo through the content addressed store."""
+        self.usage = None
+        return self.store.store(data, self.camid + '/' + filename)
+
+    def delete_photo(self, filename):
+        """Delete a photo, returning the number of bytes freed."""
+        self.usage = None
+        return self.store.remove(self.get_photo_path(filename))
+
+    def get_photo_hash(self, filename):
+        return self.store.get_hash(self.get_photo_path(filename))
+
+    def scan_storage(self):
+        """Return the photos and time lapses of the camera as a list of
+        storage groups, along with the total bytes used. Files that are
+        hard links to the same blob are only counted once."""
+        groups = {}
+        inodes = set()
+        usage = 0
+        for filename in os.listdir(self.camid):
+            name, extension = os.path.splitext(filename)
+            if extension == '.jpg':
+                packed = False
+                timelapse = '_' in name
+                if timelapse:
+                    name = name.split('_')[0]
+            elif extension in (PackedTimelapse.extension, '.idx'):
+                packed = timelapse = True
+            else:
+                continue
+            path = self.camid + '/' + filename
+            try:
+                st = os.stat(path)
+            except OSError:
+                # the file was deleted after the directory was listed
+                continue
+            size = 0
+            if st.st_ino not in inodes:
+                inodes.add(st.st_ino)
+                usage += st.st_size
+                if st.st_nlink <= 2:  # not shared with other photos
+                    size = st.st_size
+            group = groups.get(name)
+            if group is None:
+                group = StorageGroup(name, timelapse, packed, st.st_mtime,
+                                     size, [])
+            else:
+                group = group._replace(mtime=max(group.mtime, st.st_mtime),
+                                       size=group.size + size)
+            group.paths.append(path)
+            groups[name] = group
+        return list(groups.values()), usage
+
+    def enforce_retention(self, quota=None, max_age=None):
+        """Delete expired photos and time lapses, and then the oldest ones
+        until the camera is under its quota. Time lapses that are still
+        being captured are never deleted. All the selected photos are
+        deleted in a single batch. Returns the number of bytes freed."""
+        groups, usage = self.scan_storage()
+        capturing = set(self.capturing)
+        now = time.time()
+        expired = []
+        remaining = usage
+        for group in sorted(groups,
+                            key=lambda g: (not g.timelapse, g.mtime)):
+            if group.name in capturing:
+                continue
+            if (max_age is not None and now - group.mtime > max_age) or \
+                    (quota is not None and remaining > quota):
+                expired.append(group)
+                remaining -= group.size
+        freed = self.delete_groups(expired)
+        self.usage = {'bytes': usage - freed, 'quota': quota,
+                      'max_age': max_age}
+        return freed
+
+    def delete_groups(self, groups):
+        """Delete a list of storage groups. Returns the bytes freed."""
+        freed = 0
+        photos = []
+        for group in groups:
+            if group.packed:
+                # remove the data file first, which makes the time lapse
+                # disappear even if the index file is still there
+                for path in sorted(group.paths, key=lambda p: p.endswith(
+                        '.idx')):
+                    freed += os.stat(path).st_size
+                    os.remove(path)
+            else:
+                photos += group.paths
+        return freed + self.store.remove_many(photos)
+
+    def get_storage_usage(self):
+        """Return the storage used by the camera. The result of the last
+        scan is reused until photos are added or removed."""
+        if self.usage is None:
+            groups, usage = self.scan_storage()
+            self.usage = {
+                'bytes': usage,
+                'quota': app.config['STORAGE_QUOTA'].get(self.camid),
+                'max_age': app.config['STORAGE_MAX_AGE'].get(self.camid)}
+        return self.usage
+
+    def open_device(self):
+        """Open and warm up the camera device. Implemented by subclasses."""
+        raise NotImplementedError()
+
+    def close_device(self, device):
+        """Release the camera device. Implemented by subclasses."""
+        pass
+
+    def capture_frame(self, device):
+        """Capture a jpeg with the device. Implemented by subclasses."""
+        raise NotImplementedError()
+
+    def capture_frames(self, device, count, callback):
+        """Capture count jpegs back to back, passing each one to the callback
+        function. Subclasses can override this with a faster method."""
+        for i in range(count):
+            callback(self.capture_frame(device))
+
+    def capture(self):
+        """Capture a picture."""
+        filename = self.get_new_photo_filename()
+        with self.scheduler.reserve():
+            frame = self.session.execute(self.capture_frame)
+        self.save_photo(filename, frame)
+        return filename
+
+    def capture_burst(self, count):
+        """Capture a burst of pictures. The device is held for the whole
+        burst, and the pictures are written in the background."""
+        with self.scheduler.reserve():
+            writer = PhotoWriter(self, [self.get_new_photo_filename()
+                                        for i in range(count)])
+            try:
+                self.session.execute(self.capture_frames, count,
+                                     writer.write)
+            finally:
+                filenames = writer.close()
+        return filenames
+
+    def capture_timelapse(self, count, interval, packed=False, ticket=None):
+        """Capture a time lapse. Each frame takes its own turn in the capture
+        scheduler, so other captures can run in between frames. The turn of
+        the first frame can be reserved in advance by the caller."""
+        def capture_frame():
+            with ticket or self.scheduler.reserve(wait=True):
+                return self.session.execute(self.capture_frame)
+
+        if packed:
+            filename = self.get_new_photo_filename(
+                extension=PackedTimelapse.extension)
+        else:
+            filename = self.get_new_photo_filename('_{0:03d}_{1:03d}')
+        # retention leaves the files of the time lapse alone while it is
+        # being captured
+        name = os.path.splitext(filename)[0].split('_')[0]
+        self.capturing.add(name)
+        try:
+            if packed:
+                with PackedTimelapse.create(self.camid + '/' +
+                                            filename) as timelapse:
+                    for i in range(count):
+                        timelapse.append(capture_frame())
+                        ticket = None
+                        self.usage = None
+                        time.sleep(interval)
+                return filename
+            for i in range(count):
+                self.save_photo(filename.format(i, count), capture_frame())
+                ticket = None
+                time.sleep(interval)
+            return filename.format(0, count)
+        finally:
+            self.capturing.discard(name)
+            if ticket is not None:
+                self.scheduler.cancel(ticket)
 
 
 class PiCamera(BaseCamera):
@@ -103,35 +971,45 @@ class PiCamera(BaseCamera):
     def __init__(self):
         super(PiCamera, self).__init__()
         self.camid = 'pi'
+        self.store = BlobStore(self.camid + '/blobs')
+        self.session = CameraSession(self)
+        self.scheduler = CaptureScheduler(self.camid)
 
     def is_emulated(self):
         return False
 
-    def capture(self):
-        """Capture a picture."""
-        filename = self.get_new_photo_filename()
-        with picamera.PiCamera() as camera:
-            camera.resolution = (1024, 768)
-            camera.hflip = True
-            camera.vflip = True
-            camera.start_preview()
+    def open_device(self):
+        device = picamera.PiCamera()
+        try:
+            device.resolution = (1024, 768)
+            device.hflip = True
+            device.vflip = True
+            device.start_preview()
             time.sleep(2)  # wait for camera to warm up
-            camera.capture(self.camid + '/' + filename)
-        return filename
+        except:
+            device.close()
+            raise
+        return device
 
-    def capture_timelapse(self, count, interval):
-        """Capture a time lapse."""
-        filename = self.get_new_photo_filename('_{0:03d}_{1:03d}')
-        with picamera.PiCamera() as camera:
-            camera.resolution = (1024, 768)
-            camera.hflip = True
-            camera.vflip = True
-            camera.start_preview()
-            time.sleep(2)  # wait for camera to warm up
-            for i in range(count):
-                camera.capture(self.camid + '/' + filename.format(i, count))
-                time.sleep(interval)
-        return filename.format(0, count)
+    def close_device(self, device):
+        device.close()
+
+    def capture_frame(self, device):
+        # the video port is used because it captures without switching the
+        # sensor mode, which would take several hundred milliseconds
+        stream = io.BytesIO()
+        device.capture(stream, format='jpeg', use_video_port=True)
+        return stream.getvalue()
+
+    def capture_frames(self, device, count, callback):
+        stream = io.BytesIO()
+        frames = device.capture_continuous(stream, format='jpeg',
+                                           use_video_port=True)
+        for i in range(count):
+            next(frames)
+            callback(stream.getvalue())
+            stream.seek(0)
+            stream.truncate()
 
 
 class FakeCamera(BaseCamera):
@@ -139,25 +1017,23 @@ class FakeCamera(BaseCamera):
     def __init__(self):
         super(FakeCamera, self).__init__()
         self.camid = 'fake'
+        self.store = BlobStore(self.camid + '/blobs')
         self.fake_shot = open('pic.jpg', 'rb').read()
+        self.session = CameraSession(self)
+        self.scheduler = CaptureScheduler(self.camid)
 
     def is_emulated(self):
         return True
 
-    def capture(self):
-        """Capture a (fake) picture. This really copies a stock jpeg."""
-        filename = self.get_new_photo_filename()
-        open(self.camid + '/' + filename, 'wb').write(self.fake_shot)
-        return filename
+    def open_device(self):
+        """Open a (fake) device, taking as long as a real camera to warm
+        up."""
+        time.sleep(app.config['FAKE_CAMERA_WARMUP'])
+        return object()
 
-    def capture_timelapse(self, count, interval):
-        """Capture a time lapse."""
-        filename = self.get_new_photo_filename('_{0:03d}_{1:03d}')
-        for i in range(count):
-            open(self.camid + '/' + filename.format(i, count), 'wb').write(
-                self.fake_shot)
-            time.sleep(interval)
-        return filename.format(0, count)
+    def capture_frame(self, device):
+        """Capture a (fake) picture. This really returns a stock jpeg."""
+        return self.fake_shot
 
 
 def is_hardware_present():
@@ -177,6 +1053,9 @@ cameras['fake'] = FakeCamera()
 if is_hardware_present():
     cameras['pi'] = PiCamera()
 
+# start the storage retention service
+RetentionReaper().start()
+
 
 def background(f):
     """Decorator that runs the wrapped function as a background task. It is
@@ -199,10 +1078,15 @@ def background(f):
                 # invoke the wrapped function and record the returned
                 # response in the background_tasks dictionary
                 background_tasks[id] = make_response(f(*args, **kwargs))
-            except:
-                # the wrapped function raised an exception, return a 500
-                # response
-                background_tasks[id] = make_response(internal_server_error())
+            except Exception as e:
+                # the wrapped function raised an exception, use the error
+                # handler for it if there is one, else return a 500 response
+                try:
+                    background_tasks[id] = make_response(
+                        app.handle_user_exception(e))
+                except:
+                    background_tasks[id] = make_response(
+                        internal_server_error())
 
         # store the background task under a randomly generated identifier
         # and start it
@@ -217,6 +1101,15 @@ def background(f):
     return wrapped
 
 
+def streaming(f):
+    """Decorator that marks the wrapped route as returning a long lived
+    streamed response. In asynchronous mode these routes run cooperatively
+    in the server's event loop, while all other routes are sent to a pool of
+    worker threads."""
+    streaming_routes.add(f.__name__)
+    return f
+
+
 @app.route('/cameras/', methods=['GET'])
 def get_cameras():
     """Return a list of available cameras."""
@@ -242,15 +1135,29 @@ def get_camera_photos(camid):
 @app.route('/cameras/<camid>/photos/<filename>', methods=['GET'])
 def get_photo(camid, filename):
     """Return a photo. Photos are in jpeg format, they can be viewed in
-    a web browser."""
+    a web browser. The content hash of the photo is used as its ETag."""
     camera = get_camera_from_id(camid)
     path = camera.get_photo_path(filename)
-    return send_file(path)
+    digest = camera.get_photo_hash(filename)
+    if digest is None:
+        return send_file(path)
+    rv = send_file(path, add_etags=False)
+    rv.set_etag(digest)
+    return rv.make_conditional(request)
 
 @app.route('/cameras/<camid>/photos/', methods=['POST'])
 def capture_photo(camid):
-    """Capture a photo."""
+    """Capture a photo. If burst=N is given in the query string, N photos
+    are captured in quick succession and the response lists their URLs."""
     camera = get_camera_from_id(camid)
+    burst = request.args.get('burst', 0, type=int)
+    if burst:
+        if burst < 0 or burst > app.config['MAX_BURST']:
+            return bad_request()
+        photos = [url_for('get_photo', camid=camid, filename=filename,
+                          _external=True)
+                  for filename in camera.capture_burst(burst)]
+        return jsonify({'photos': photos}), 201, {'Location': photos[0]}
     filename = camera.capture()
     return jsonify({}), 201, {'Location': url_for('get_photo', camid=camid,
                                                   filename=filename,
@@ -260,30 +1167,75 @@ def capture_photo(camid):
 def delete_photo(camid, filename):
     """Delete a photo."""
     camera = get_camera_from_id(camid)
-    path = camera.get_photo_path(filename)
-    os.remove(path)
+    camera.delete_photo(filename)
     return jsonify({})
 
-def stream_timelapse(path):
-    """Stream the jpegs in a time lapse as a multipart response."""
-    parts = path.split('.')[0].split('_')
-    count = int(parts[2])
-    filename = parts[0] + '_{0:03d}_{1:03d}.jpg'
-    for i in range(count):
-        frame = open(filename.format(i, count), 'rb').read()
-        yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + \
-            str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n'
-        time.sleep(0.5)
+def stream_timelapse(timelapse, start=0, fps=2):
+    """Stream the jpegs in a time lapse as a multipart response. The next
+    frame is loaded in the background while the current one is sent, and
+    frames are yielded as separate chunks to avoid copying them."""
+    try:
+        interval = 1.0 / fps
+        loader = scheduler.load(timelapse.get_frame, start)
+        next_time = time.time()
+        for i in range(start, timelapse.count):
+            frame = loader.get()
+            if i + 1 < timelapse.count:
+                loader = scheduler.load(timelapse.get_frame, i + 1)
+            yield b'\r\n--frame\r\nContent-Type: image/jpeg\r\n' \
+                b'Content-Length: ' + str(len(frame)).encode() + b'\r\n\r\n'
+            yield frame
+            if i + 1 < timelapse.count:
+                # sleep until the next frame is due, discounting the time it
+                # took to send this one
+                next_time += interval
+                delay = next_time - time.time()
+                if delay > 0:
+                    scheduler.sleep(delay)
+    finally:
+        timelapse.close()
 
 @app.route('/cameras/<camid>/timelapses/<filename>', methods=['GET'])
+@streaming
 def get_timelapse(camid, filename):
     """Return a time lapse sequence. Time lapses are returned as a streamed
-    multipart response. Most browsers display the sequence of pictures."""
+    multipart response. Most browsers display the sequence of pictures.
+    The playback rate and the first frame can be given in the fps and from
+    arguments of the query string."""
     camera = get_camera_from_id(camid)
-    path = camera.get_photo_path(filename)
-    return Response(stream_timelapse(path),
+    fps = request.args.get('fps', 2, type=float)
+    start = request.args.get('from', 0, type=int)
+    if fps <= 0 or start < 0:
+        return bad_request()
+    timelapse = camera.get_timelapse(filename)
+    if start >= timelapse.count:
+        # same as asking for a frame that does not exist
+        timelapse.close()
+        raise InvalidPhoto()
+    return Response(stream_timelapse(timelapse, start, fps),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/cameras/<camid>/timelapses/<filename>/frames/<int:n>',
+           methods=['GET'])
+def get_timelapse_frame(camid, filename, n):
+    """Return a single frame of a time lapse, as a jpeg image."""
+    camera = get_camera_from_id(camid)
+    timelapse = camera.get_timelapse(filename)
+    try:
+        frame = timelapse.get_frame(n)
+    finally:
+        timelapse.close()
+    return Response(frame, mimetype='image/jpeg')
+
+@app.route('/cameras/<camid>/timelapses/<filename>', methods=['DELETE'])
+def delete_timelapse(camid, filename):
+    """Delete a time lapse, including all its frames."""
+    camera = get_camera_from_id(camid)
+    timelapse = camera.get_timelapse(filename)
+    timelapse.delete()
+    camera.usage = None
+    return jsonify({})
+
 @app.route('/cameras/<camid>/timelapses/<filename>/html', methods=['GET'])
 def get_timelapse_html(camid, filename):
     """Return an HTML wrapper page for the timelapse stream. This is required
@@ -291,15 +1243,55 @@ def get_timelapse_html(camid, filename):
     return '<img src="{0}">'.format(url_for('get_timelapse', camid=camid,
                                             filename=filename))
 
+def stream_live(broadcast):
+    """Stream the live feed of a camera as a multipart response."""
+    seq = broadcast.subscribe()
+    try:
+        while True:
+            seq, frame = scheduler.wait_frame(broadcast, seq)
+            if frame is None:
+                break
+            yield b'\r\n--frame\r\nContent-Type: image/jpeg\r\n' \
+                b'Content-Length: ' + str(len(frame)).encode() + b'\r\n\r\n'
+            yield frame
+    finally:
+        broadcast.unsubscribe()
+
+@app.route('/cameras/<camid>/live', methods=['GET'])
+@streaming
+def get_live(camid):
+    """Return the live feed of a camera, as a streamed multipart response.
+    All the viewers of a camera share the same capture loop."""
+    camera = get_camera_from_id(camid)
+    return Response(stream_live(camera.broadcast),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/cameras/<camid>/live/html', methods=['GET'])
+def get_live_html(camid):
+    """Return an HTML wrapper page for the live stream."""
+    return '<img src="{0}">'.format(url_for('get_live', camid=camid))
+
 @app.route('/cameras/<camid>/timelapses/', methods=['POST'])
-@background
 def capture_timelapse(camid):
     """Capture a 30 second time lapse sequence, at a rate of a picture per
-    second. Note this is an asynchronous request."""
+    second. Note this is an asynchronous request. Time lapses are stored as
+    a file per frame, or as a single packed file if packed=1 is given in the
+    query string. The request is rejected right away if the camera's capture
+    queue is full."""
+    camera = get_camera_from_id(camid)
+    ticket = camera.scheduler.reserve()
+    return capture_timelapse_task(camid, ticket)
+
+@background
+def capture_timelapse_task(camid, ticket):
+    """Background task that captures a time lapse, starting with the given
+    capture scheduler ticket."""
     count = request.args.get('count', 30, type=int)
     interval = request.args.get('interval', 1, type=float)
+    packed = request.args.get('packed', int(app.config['PACKED_TIMELAPSES']),
+                              type=int) != 0
     camera = get_camera_from_id(camid)
-    filename = camera.capture_timelapse(count, interval)
+    filename = camera.capture_timelapse(count, interval, packed, ticket)
     return jsonify({}), 201, {'Location': url_for('get_timelapse',
                                                   camid=camid,
                                                   filename=filename,
@@ -345,5 +1337,39 @@ def delete_task_status(id):
     return jsonify({}), 200
 
 
+def make_async_app():
+    """Return the WSGI application for the asynchronous mode, which must run
+    on a gevent server. Streaming routes run as greenlets, so each viewer
+    costs a greenlet instead of a thread. All other routes keep their
+    blocking behavior and run in a pool of ASYNC_THREADS threads. Frames
+    are loaded by a separate pool of LOADER_THREADS threads, so that streams
+    and slow routes do not wait for each other."""
+    global scheduler
+    if gevent is None:
+        raise RuntimeError('The asynchronous mode requires gevent, install '
+                           'it with "pip install gevent".')
+    pool = ThreadPool(app.config['ASYNC_THREADS'])
+    scheduler = CooperativeStreamScheduler(
+        ThreadPool(app.config['LOADER_THREADS']))
+
+    def application(environ, start_response):
+        try:
+            endpoint, args = app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint = None
+        if endpoint in streaming_routes:
+            return app(environ, start_response)
+        return pool.apply(app, (environ, start_response))
+    return application
+
+
+def serve_async(host='0.0.0.0', port=5000):
+    """Run the application on a gevent server."""
+    WSGIServer((host, port), make_async_app()).serve_forever()
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True)
+    if os.environ.get('CAMERA_ASYNC'):
+        serve_async()
+    else:
+        app.run(host='0.0.0.0', debug=True)
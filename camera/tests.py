@@ -0,0 +1,395 @@
+# run from this directory with: python -m unittest tests
+import os
+import json
+import time
+import shutil
+import unittest
+from threading import Thread
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+import camera
+
+
+class TestCamera(unittest.TestCase):
+    def setUp(self):
+        # photos written by the tests are removed when they end
+        self.files = set(os.listdir('fake'))
+        self.config = camera.app.config.copy()
+        camera.app.config['FAKE_CAMERA_WARMUP'] = 0.01
+        camera.app.config['CAPTURE_CONCURRENCY'] = {}
+        camera.app.config['CAPTURE_QUEUE_SIZE'] = 1
+        camera.app.config['CAPTURE_TIMEOUT'] = 5
+        self.camera = camera.cameras['fake'] = camera.FakeCamera()
+        self.opened = 0
+        open_device = self.camera.open_device
+
+        def counted_open_device():
+            self.opened += 1
+            return open_device()
+        self.camera.open_device = counted_open_device
+        self.client = camera.app.test_client()
+
+    def tearDown(self):
+        self.camera.session.stop()
+        camera.app.config.clear()
+        camera.app.config.update(self.config)
+        for filename in set(os.listdir('fake')) - self.files:
+            path = os.path.join('fake', filename)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def hold_camera(self):
+        """Take the camera's only capture slot, which is given back when
+        the returned ticket's with statement ends."""
+        ticket = self.camera.scheduler.reserve()
+        ticket.__enter__()
+        return ticket
+
+    def wait_for_waiting(self, n):
+        deadline = time.time() + 5
+        while len(self.camera.scheduler.waiting) < n:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_capture(self):
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+        rv = self.client.get(rv.headers['Location'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.data == self.camera.fake_shot)
+
+    def test_full_queue(self):
+        ticket = self.hold_camera()
+        try:
+            waiting = self.camera.scheduler.reserve()
+            rv = self.client.post('/cameras/fake/photos/')
+            self.assertTrue(rv.status_code == 503)
+            self.assertTrue(rv.headers['Retry-After'] == str(
+                camera.app.config['CAPTURE_RETRY_AFTER']))
+            self.camera.scheduler.cancel(waiting)
+        finally:
+            ticket.__exit__(None, None, None)
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+
+    def test_ticket_timeout(self):
+        camera.app.config['CAPTURE_TIMEOUT'] = 0.05
+        ticket = self.hold_camera()
+        try:
+            start = time.time()
+            with self.assertRaises(camera.CameraBusy):
+                with self.camera.scheduler.reserve():
+                    pass
+            self.assertTrue(time.time() - start >= 0.05)
+            self.assertTrue(len(self.camera.scheduler.waiting) == 0)
+        finally:
+            ticket.__exit__(None, None, None)
+
+    def test_timelapse_stream(self):
+        filename = self.camera.capture_timelapse(3, 0)
+        url = '/cameras/fake/timelapses/' + filename
+
+        # all the frames are streamed, or the ones after the first one given
+        rv = self.client.get(url + '?fps=1000')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.data.count(b'--frame') == 3)
+        self.assertTrue(rv.data.count(self.camera.fake_shot) == 3)
+        rv = self.client.get(url + '?fps=1000&from=2')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.data.count(b'--frame') == 1)
+
+        # a first frame past the end is rejected before the stream starts
+        rv = self.client.get(url + '?from=3')
+        self.assertTrue(rv.status_code == 404)
+        rv = self.client.get(url + '?from=-1')
+        self.assertTrue(rv.status_code == 400)
+        rv = self.client.get(url + '?fps=0')
+        self.assertTrue(rv.status_code == 400)
+
+    def test_packed_timelapse(self):
+        frames = [b'first', b'second frame', b'', b'fourth']
+        path = 'fake/' + self.camera.get_new_photo_filename(
+            extension=camera.PackedTimelapse.extension)
+        with camera.PackedTimelapse.create(path) as writer:
+            for frame in frames:
+                writer.append(frame)
+
+        # each frame is found through its own index entries
+        timelapse = camera.PackedTimelapse(path)
+        try:
+            self.assertTrue(timelapse.count == 4)
+            for n in (3, 0, 2, 1):
+                self.assertTrue(timelapse.get_frame(n) == frames[n])
+            with self.assertRaises(camera.InvalidPhoto):
+                timelapse.get_frame(4)
+            with self.assertRaises(camera.InvalidPhoto):
+                timelapse.get_frame(-1)
+        finally:
+            timelapse.close()
+
+        url = '/cameras/fake/timelapses/' + os.path.basename(path)
+        rv = self.client.get(url + '/frames/1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.data == b'second frame')
+        rv = self.client.get(url + '/frames/4')
+        self.assertTrue(rv.status_code == 404)
+        rv = self.client.delete(url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(timelapse.index_path))
+
+    def test_blob_store(self):
+        store = self.camera.store
+        size = len(self.camera.fake_shot)
+        paths = ['fake/' + self.camera.get_new_photo_filename()
+                 for i in range(3)]
+        digests = [store.store(self.camera.fake_shot, path)
+                   for path in paths]
+        if not store.hard_links:
+            self.skipTest('the filesystem does not support hard links')
+
+        # identical photos share a single blob
+        self.assertTrue(len(set(digests)) == 1)
+        blob_path = store.get_blob_path(digests[0])
+        self.assertTrue(os.stat(blob_path).st_nlink == 4)
+        self.assertTrue(store.get_hash(paths[1]) == digests[0])
+
+        # the blob is freed with its last photo
+        self.assertTrue(store.remove(paths[0]) == 0)
+        self.assertTrue(os.path.exists(blob_path))
+
+        # photos that are already gone do not stop a batch
+        self.assertTrue(store.remove_many(
+            [paths[0], paths[1], 'fake/missing.jpg', paths[2]]) == size)
+        self.assertFalse(os.path.exists(blob_path))
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def save_photo(self, filename, age):
+        """Write a 1000 byte photo of its own, last modified age seconds
+        ago."""
+        self.camera.save_photo(filename, os.urandom(1000))
+        mtime = time.time() - age
+        os.utime('fake/' + filename, (mtime, mtime))
+
+    def test_retention(self):
+        for filename, age in [('a.jpg', 300), ('b.jpg', 200),
+                              ('c.jpg', 100), ('t_000_002.jpg', 50),
+                              ('t_001_002.jpg', 50)]:
+            self.save_photo(filename, age)
+
+        # time lapses go first, then the oldest photos
+        self.assertTrue(self.camera.enforce_retention(quota=2500) == 3000)
+        self.assertTrue(sorted(self.camera.get_photos()) ==
+                        ['b.jpg', 'c.jpg'])
+        self.assertTrue(self.camera.get_storage_usage()['bytes'] == 2000)
+
+        # photos past their max age go regardless of the quota
+        self.assertTrue(self.camera.enforce_retention(
+            quota=2500, max_age=150) == 1000)
+        self.assertTrue(self.camera.get_photos() == ['c.jpg'])
+
+    def test_retention_capture(self):
+        self.save_photo('a.jpg', 100)
+        timelapse = Thread(target=self.camera.capture_timelapse,
+                           args=(2, 0.3))
+        timelapse.start()
+        deadline = time.time() + 5
+        while len(self.camera.get_photos()) < 2:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+        # a time lapse is not deleted while it is being captured
+        self.camera.enforce_retention(quota=0)
+        timelapse.join()
+        photos = self.camera.get_photos()
+        self.assertTrue(len(photos) == 2)
+        self.assertFalse('a.jpg' in photos)
+
+        # but it is once it is complete
+        self.camera.enforce_retention(quota=0)
+        self.assertTrue(self.camera.get_photos() == [])
+
+    @unittest.skipIf(camera.gevent is None, 'gevent is not installed')
+    def test_async_app(self):
+        scheduler = camera.scheduler
+        try:
+            client = Client(camera.make_async_app(), BaseResponse)
+            self.assertTrue(camera.scheduler is not scheduler)
+
+            # blocking routes run in the worker pool
+            rv = client.post('/cameras/fake/photos/')
+            self.assertTrue(rv.status_code == 201)
+
+            # and streams load their frames in a pool of their own
+            filename = self.camera.capture_timelapse(3, 0)
+            rv = client.get('/cameras/fake/timelapses/{0}?fps=1000'.format(
+                filename))
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(rv.data.count(self.camera.fake_shot) == 3)
+        finally:
+            camera.scheduler.pool.kill()
+            camera.scheduler = scheduler
+
+    def test_capture_order(self):
+        ticket = self.hold_camera()
+
+        # record the captures in the order they get the camera
+        order = []
+        acquire = self.camera.scheduler.acquire
+
+        def recorded_acquire(ticket):
+            acquire(ticket)
+            order.append('timelapse' if ticket.timeout is None
+                         else 'photo')
+        self.camera.scheduler.acquire = recorded_acquire
+
+        # a photo requested while a time lapse is waiting for its first
+        # frame is taken before the second frame
+        camera.app.config['CAPTURE_QUEUE_SIZE'] = 2
+        try:
+            timelapse = Thread(target=self.camera.capture_timelapse,
+                               args=(2, 0))
+            timelapse.start()
+            self.wait_for_waiting(1)
+            photo = Thread(target=self.camera.capture)
+            photo.start()
+            self.wait_for_waiting(2)
+        finally:
+            ticket.__exit__(None, None, None)
+        timelapse.join()
+        photo.join()
+        self.assertTrue(order == ['timelapse', 'photo', 'timelapse'])
+        self.assertTrue(len(self.camera.get_photos()) == 3)
+
+    def test_session(self):
+        camera.app.config['CAMERA_IDLE_TIMEOUT'] = 0.1
+
+        # the device is opened once for consecutive captures
+        for i in range(3):
+            rv = self.client.post('/cameras/fake/photos/')
+            self.assertTrue(rv.status_code == 201)
+        self.assertTrue(self.opened == 1)
+
+        # and reopened after it was closed for being idle
+        time.sleep(0.3)
+        self.assertTrue(self.camera.session.device is None)
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(self.opened == 2)
+
+    def test_session_close_error(self):
+        camera.app.config['CAMERA_IDLE_TIMEOUT'] = 0.05
+
+        def close_device(device):
+            raise RuntimeError('cannot close')
+        self.camera.close_device = close_device
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+        time.sleep(0.2)
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(self.opened == 2)
+
+    def test_session_job_timeout(self):
+        camera.app.config['CAMERA_JOB_TIMEOUT'] = 0.05
+        session = self.camera.session
+        ran = []
+
+        def slow_job(device):
+            time.sleep(0.2)
+            ran.append('slow')
+
+        def queued_job(device):
+            ran.append('queued')
+
+        # a job that times out raises CameraBusy, and a job that timed out
+        # while waiting in the queue is never run
+        with self.assertRaises(camera.CameraBusy):
+            session.execute(slow_job)
+        with self.assertRaises(camera.CameraBusy):
+            session.execute(queued_job)
+        camera.app.config['CAMERA_JOB_TIMEOUT'] = 5
+        self.assertTrue(session.execute(lambda device: device) is not None)
+        self.assertTrue(ran == ['slow'])
+
+    def test_session_stop(self):
+        closed = []
+        self.camera.close_device = closed.append
+        rv = self.client.post('/cameras/fake/photos/')
+        self.assertTrue(rv.status_code == 201)
+        self.camera.session.stop()
+        self.assertFalse(self.camera.session.is_alive())
+        self.assertTrue(self.camera.session.device is None)
+        self.assertTrue(len(closed) == 1)
+
+    def test_broadcast(self):
+        camera.app.config['LIVE_FPS'] = 100
+        broadcast = self.camera.broadcast
+
+        # all the subscribers get the frames of a single capture loop
+        seqs = [broadcast.subscribe(), broadcast.subscribe()]
+        thread = broadcast.thread
+        for i in range(3):
+            for j in range(len(seqs)):
+                seqs[j], frame = broadcast.get_frame(seqs[j])
+                self.assertTrue(frame == self.camera.fake_shot)
+        self.assertTrue(broadcast.thread is thread)
+        self.assertTrue(self.opened == 1)
+
+        # a subscriber that falls behind skips to the newest frame
+        deadline = time.time() + 5
+        while broadcast.seq <= seqs[0] + len(broadcast.frames):
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        seq, frame = broadcast.get_frame(seqs[0])
+        self.assertTrue(seq > seqs[0] + len(broadcast.frames))
+        self.assertTrue(frame == self.camera.fake_shot)
+
+        # the capture loop ends with the last subscriber
+        broadcast.unsubscribe()
+        broadcast.unsubscribe()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(broadcast.thread is None)
+
+    def test_burst(self):
+        rv = self.client.post('/cameras/fake/photos/?burst=5')
+        self.assertTrue(rv.status_code == 201)
+        photos = json.loads(rv.data.decode('utf-8'))['photos']
+        self.assertTrue(len(photos) == 5)
+        self.assertTrue(len(set(photos)) == 5)
+        self.assertTrue(rv.headers['Location'] == photos[0])
+        for photo in photos:
+            rv = self.client.get(photo)
+            self.assertTrue(rv.status_code == 200)
+        self.assertTrue(self.opened == 1)
+
+        rv = self.client.post('/cameras/fake/photos/?burst=-1')
+        self.assertTrue(rv.status_code == 400)
+
+    def test_burst_limit(self):
+        camera.app.config['MAX_BURST'] = 3
+        rv = self.client.post('/cameras/fake/photos/?burst=4')
+        self.assertTrue(rv.status_code == 400)
+        self.assertTrue(self.camera.get_photos() == [])
+        rv = self.client.post('/cameras/fake/photos/?burst=3')
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(len(self.camera.get_photos()) == 3)
+
+    def test_burst_write_error(self):
+        def save_photo(filename, data):
+            raise IOError('disk full')
+        self.camera.save_photo = save_photo
+
+        # the error is raised once the capture is done, and the camera is
+        # given back to the scheduler
+        with self.assertRaises(IOError):
+            self.camera.capture_burst(3)
+        self.assertTrue(self.camera.scheduler.running == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
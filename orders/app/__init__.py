@@ -1,9 +1,23 @@
 import os
-from flask import Flask, jsonify, g
-from flask.ext.sqlalchemy import SQLAlchemy
+import sqlite3
+from flask import Flask, jsonify, g, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from .decorators import json, no_cache, rate_limit
+from .shards import ShardedSQLAlchemy
+from . import metrics
 
-db = SQLAlchemy()
+db = ShardedSQLAlchemy()
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys unless they are enabled on each
+    connection, and they are needed for cascading deletes."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
 
 def create_app(config_name):
@@ -21,13 +35,27 @@ def create_app(config_name):
     from .api_v1 import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api/v1')
 
+    # collect metrics for all requests
+    metrics.install_sql_events()
+
+    @app.before_request
+    def before_request():
+        metrics.start_request()
+
     # register an after request handler
     @app.after_request
     def after_request(rv):
         headers = getattr(g, 'headers', {})
         rv.headers.extend(headers)
+        metrics.finish_request(rv)
         return rv
 
+    # metrics route, in Prometheus text format
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     # authentication token route
     from .auth import auth
     @app.route('/get-auth-token')
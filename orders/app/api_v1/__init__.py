@@ -1,23 +1,36 @@
 from flask import Blueprint
 from ..auth import auth_token
-from ..decorators import etag, rate_limit
+from ..decorators import etag, rate_limit, compress
 
 api = Blueprint('api', __name__)
 
 
+@rate_limit(limit=125, period=15)
+def check_rate_limit():
+    """Rate limit the current request for the authenticated user, with a
+    budget of five expanded pages or 125 single resources every 15 seconds.
+    Returns a response if the request is over the limit. This is also used
+    for each of the requests in a batch."""
+    pass
+
+
 @api.before_request
-@rate_limit(limit=5, period=15)
 @auth_token.login_required
 def before_request():
-    """All routes in this blueprint require authentication."""
-    pass
+    """All routes in this blueprint require authentication, and are rate
+    limited for each user. Requests that fail authentication are rate
+    limited for each IP address by the authentication error handler."""
+    return check_rate_limit()
 
 
 @api.after_request
 @etag
+@compress
 def after_request(rv):
-    """Generate an ETag header for all routes in this blueprint."""
+    """Compress the response and generate an ETag header for all routes in
+    this blueprint. Compression runs first, so that each encoding of a
+    resource gets its own ETag."""
     return rv
 
 
-from . import customers, products, orders, items, errors
+from . import customers, products, orders, items, batch, changes, errors
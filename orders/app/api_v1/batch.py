@@ -0,0 +1,115 @@
+import json
+from contextlib import contextmanager
+from flask import request, current_app, url_for
+from werkzeug.urls import url_parse
+from . import api, check_rate_limit
+from .errors import internal_server_error
+from .. import db
+from ..decorators import json as json_response, rate_cost
+from ..exceptions import ValidationError
+from ..representations import request_data
+
+
+@contextmanager
+def deferred_commits(enabled=True):
+    """Turn the commits issued by the routes into flushes, so that all the
+    changes made by a batch can be committed or rolled back together."""
+    if not enabled:
+        yield
+        return
+    session = db.session()
+    session.commit = session.flush
+    try:
+        yield
+    finally:
+        del session.commit
+
+
+def dispatch(method, url, body):
+    """Dispatch a sub-request through the application's URL map and return
+    its response. The sub-request runs in its own request context, but it
+    shares the application context, and with it the database session and
+    the authenticated user, with the batch request. Each sub-request is
+    rate limited as if it was sent on its own."""
+    parsed_url = url_parse(url)
+    if parsed_url.netloc not in ['', request.host]:
+        raise ValidationError('Invalid URL: ' + url)
+    if parsed_url.path == url_for('api.batch'):
+        raise ValidationError('Batch requests cannot be nested')
+    with current_app.test_request_context(
+            parsed_url.path, base_url=request.url_root,
+            query_string=parsed_url.query, method=method,
+            data=json.dumps(body) if body is not None else None,
+            headers={'Content-Type': 'application/json',
+                     'Accept': 'application/json'}):
+        try:
+            rv = check_rate_limit()
+            if rv is None:
+                rv = current_app.dispatch_request()
+        except Exception as e:
+            try:
+                rv = current_app.handle_user_exception(e)
+            except Exception:
+                # the requests that came before this one may have been
+                # committed already, so only this request fails
+                current_app.logger.exception('Batch request failed')
+                rv = internal_server_error(
+                    Exception('the request could not be completed'))
+        rv = current_app.make_response(rv)
+        if rv.is_streamed:
+            # streams such as event feeds may never end, so they cannot be
+            # buffered into the batch response
+            rv.close()
+            raise ValidationError('Streamed responses cannot be batched: ' +
+                                  url)
+        return rv
+
+
+@api.route('/batch', methods=['POST'])
+@rate_cost(0)  # each request in the batch is charged on its own
+@json_response
+def batch():
+    """Run a list of requests, given as method, url and optional body, and
+    return the status, headers and body of each. With atomic set to true,
+    the changes made by all the requests are committed only when all of
+    them succeed."""
+    data = request_data()
+    try:
+        requests = data['requests']
+        atomic = bool(data.get('atomic', False))
+    except (KeyError, TypeError, AttributeError):
+        raise ValidationError('Invalid batch: missing requests')
+    if not isinstance(requests, list):
+        raise ValidationError('Invalid batch: requests must be a list')
+    if len(requests) > current_app.config.get('BATCH_MAX_REQUESTS', 50):
+        raise ValidationError('Invalid batch: too many requests')
+
+    responses = []
+    with deferred_commits(atomic):
+        for sub in requests:
+            try:
+                method = sub.get('method', 'GET').upper()
+                url = sub['url']
+            except (KeyError, TypeError, AttributeError):
+                raise ValidationError('Invalid batch: missing url')
+            rv = dispatch(method, url, sub.get('body'))
+            body = rv.get_data(as_text=True)
+            if rv.mimetype == 'application/json':
+                body = json.loads(body)
+            responses.append({'status': rv.status_code,
+                              'headers': dict(rv.headers),
+                              'body': body})
+            if rv.status_code >= 400:
+                # discard any changes the failed request left in the
+                # session, and in atomic mode also those of the requests
+                # that came before it
+                db.session.rollback()
+                if atomic:
+                    break
+    rv = {'responses': responses}
+    if atomic:
+        rv['committed'] = len(responses) == len(requests) and \
+            all(r['status'] < 400 for r in responses)
+        if rv['committed']:
+            db.session.commit()
+    return rv
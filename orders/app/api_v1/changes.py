@@ -0,0 +1,24 @@
+from flask import request, url_for, current_app
+from . import api
+from ..models import Change
+from ..decorators import json
+from ..exceptions import ValidationError
+
+
+@api.route('/changes/', methods=['GET'])
+@json
+def get_changes():
+    """Return the changes made after the given sequence number, in order.
+    Clients can poll next_url to receive the changes that come later."""
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if limit < 1:
+        raise ValidationError('Invalid limit: ' + str(limit))
+    limit = min(limit, current_app.config.get('CHANGES_MAX_LIMIT', 1000))
+    changes = Change.query.filter(Change.seq > after) \
+        .order_by(Change.seq).limit(limit).all()
+    last_seq = changes[-1].seq if changes else after
+    return {'changes': [change.export_data() for change in changes],
+            'last_seq': last_seq,
+            'next_url': url_for('api.get_changes', after=last_seq,
+                                limit=limit, _external=True)}
@@ -1,8 +1,9 @@
-from flask import request
 from . import api
 from .. import db
 from ..models import Customer
 from ..decorators import json, paginate
+from ..representations import request_data
+from ..utils import check_if_match
 
 
 @api.route('/customers/', methods=['GET'])
@@ -20,7 +21,7 @@ def get_customer(id):
 @json
 def new_customer():
     customer = Customer()
-    customer.import_data(request.json)
+    customer.import_data(request_data())
     db.session.add(customer)
     db.session.commit()
     return {}, 201, {'Location': customer.get_url()}
@@ -29,7 +30,8 @@ def new_customer():
 @json
 def edit_customer(id):
     customer = Customer.query.get_or_404(id)
-    customer.import_data(request.json)
+    check_if_match(customer)
+    customer.import_data(request_data())
     db.session.add(customer)
     db.session.commit()
     return {}
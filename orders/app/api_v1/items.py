@@ -1,28 +1,30 @@
-from flask import request
 from . import api
 from .. import db
-from ..models import Order, Item
+from ..models import Order, Item, ArchivedOrder, ArchivedItem
 from ..decorators import json, paginate
+from ..representations import request_data
+from ..utils import check_if_match
 
 
 @api.route('/orders/<int:id>/items/', methods=['GET'])
 @json
 @paginate('items')
 def get_order_items(id):
-    order = Order.query.get_or_404(id)
+    # orders that are not in the orders table can be in the archive
+    order = Order.query.get(id) or ArchivedOrder.query.get_or_404(id)
     return order.items
 
 @api.route('/items/<int:id>', methods=['GET'])
 @json
 def get_item(id):
-    return Item.query.get_or_404(id).export_data()
+    return Item.query.get(id) or ArchivedItem.query.get_or_404(id)
 
 @api.route('/orders/<int:id>/items/', methods=['POST'])
 @json
 def new_order_item(id):
     order = Order.query.get_or_404(id)
     item = Item(order=order)
-    item.import_data(request.json)
+    item.import_data(request_data())
     db.session.add(item)
     db.session.commit()
     return {}, 201, {'Location': item.get_url()}
@@ -31,7 +33,8 @@ def new_order_item(id):
 @json
 def edit_item(id):
     item = Item.query.get_or_404(id)
-    item.import_data(request.json)
+    check_if_match(item)
+    item.import_data(request_data())
     db.session.add(item)
     db.session.commit()
     return {}
@@ -40,6 +43,7 @@ def edit_item(id):
 @json
 def delete_item(id):
     item = Item.query.get_or_404(id)
+    check_if_match(item)
     db.session.delete(item)
     db.session.commit()
     return {}
@@ -1,8 +1,16 @@
-from flask import request
+from dateutil import parser as datetime_parser
+from dateutil.tz import tzutc
+from flask import request, current_app, Response, stream_with_context
 from . import api
 from .. import db
-from ..models import Order, Customer
+from ..exceptions import ValidationError
+from ..models import Order, Customer, Item, Change, ArchivedOrder, \
+    record_deletes
 from ..decorators import json, paginate
+from ..events import hub
+from ..serializers import get_serializer, url_builder
+from ..representations import request_data
+from ..utils import check_if_match
 
 
 @api.route('/orders/', methods=['GET'])
@@ -16,19 +24,27 @@ def get_orders():
 @paginate('orders')
 def get_customer_orders(id):
     customer = Customer.query.get_or_404(id)
-    return customer.orders
+    # include the customer's archived orders
+    hot = customer.orders.with_entities(
+        Order.id, Order.customer_id, Order.date, Order.version)
+    archived = ArchivedOrder.query.filter_by(customer_id=id).with_entities(
+        ArchivedOrder.id, ArchivedOrder.customer_id, ArchivedOrder.date,
+        ArchivedOrder.version)
+    return Order.query.select_entity_from(
+        hot.union_all(archived).subquery()).order_by(Order.id)
 
 @api.route('/orders/<int:id>', methods=['GET'])
 @json
 def get_order(id):
-    return Order.query.get_or_404(id)
+    # orders that are not in the orders table can be in the archive
+    return Order.query.get(id) or ArchivedOrder.query.get_or_404(id)
 
 @api.route('/customers/<int:id>/orders/', methods=['POST'])
 @json
 def new_customer_order(id):
     customer = Customer.query.get_or_404(id)
     order = Order(customer=customer)
-    order.import_data(request.json)
+    order.import_data(request_data())
     db.session.add(order)
     db.session.commit()
     return {}, 201, {'Location': order.get_url()}
@@ -37,7 +53,8 @@ def new_customer_order(id):
 @json
 def edit_order(id):
     order = Order.query.get_or_404(id)
-    order.import_data(request.json)
+    check_if_match(order)
+    order.import_data(request_data())
     db.session.add(order)
     db.session.commit()
     return {}
@@ -46,6 +63,97 @@ def edit_order(id):
 @json
 def delete_order(id):
     order = Order.query.get_or_404(id)
+    check_if_match(order)
     db.session.delete(order)
     db.session.commit()
     return {}
+
+@api.route('/orders/', methods=['DELETE'])
+@json
+def delete_orders():
+    """Delete the orders placed before the date given in the before
+    argument, along with their items. The orders are deleted in chunks of
+    BULK_DELETE_CHUNK, each in its own transaction, so that the tables are
+    never locked for long. Each shard is processed in turn."""
+    try:
+        before = datetime_parser.parse(request.args['before']).astimezone(
+            tzutc()).replace(tzinfo=None)
+    except KeyError:
+        raise ValidationError('Missing before argument')
+    except (ValueError, TypeError):
+        raise ValidationError('Invalid date: ' + request.args['before'])
+    chunk_size = current_app.config.get('BULK_DELETE_CHUNK', 500)
+    deleted = 0
+    for shard_id in db.session().shard_ids:
+        while True:
+            ids = [id for id, in db.session.query(Order.id).set_shard(
+                shard_id).filter(Order.date < before).limit(chunk_size)]
+            if not ids:
+                break
+            record_deletes(db.session, Item, Item.order_id.in_(ids))
+            record_deletes(db.session, Order, Order.id.in_(ids))
+            # the items are deleted by the database, through the foreign key
+            deleted += Order.query.filter(Order.id.in_(ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+    return {'deleted': deleted}
+
+@api.route('/orders/events', methods=['GET'])
+def get_order_events():
+    """Stream the changes made to orders and items as server-sent events.
+    Clients that reconnect with a Last-Event-ID header first receive the
+    changes they missed."""
+    models = ['Order', 'Item']
+    event_names = {'create': 'created', 'update': 'updated',
+                   'delete': 'deleted'}
+    last_seq = request.headers.get('Last-Event-ID', type=int)
+    if last_seq is None:
+        last_seq = request.args.get('last_event_id', type=int)
+    keepalive = current_app.config.get('EVENTS_KEEPALIVE', 15)
+    subscription = hub.subscribe(
+        models, current_app.config.get('EVENTS_QUEUE_SIZE', 100))
+
+    def format_event(change):
+        url = url_builder(get_serializer(change.model).endpoint)(
+            change.resource_id)
+        return 'id: {0}\nevent: {1}\ndata: {{"url": "{2}"}}\n\n'.format(
+            change.seq, event_names[change.operation], url)
+
+    def generate():
+        seq = last_seq
+        try:
+            # send the changes the client missed, in chunks, and release
+            # the database session before waiting for new ones
+            while seq is not None:
+                changes = Change.query.filter(
+                    Change.seq > seq, Change.model.in_(models)) \
+                    .order_by(Change.seq).limit(500).all()
+                for change in changes:
+                    yield format_event(change)
+                    seq = change.seq
+                if len(changes) < 500:
+                    break
+            db.session.remove()
+
+            while True:
+                change = subscription.get(keepalive)
+                if change is None:
+                    yield ': keepalive\n\n'
+                elif seq is None or change.seq > seq:
+                    yield format_event(change)
+                    seq = change.seq
+                if subscription.overflowed and subscription.queue.empty():
+                    # the client is too slow; it can resume from the last
+                    # event it received when it reconnects
+                    break
+        finally:
+            hub.unsubscribe(subscription)
+
+    rv = Response(stream_with_context(generate()),
+                  mimetype='text/event-stream',
+                  headers={'Cache-Control': 'no-cache'})
+
+    # the subscription also has to be released when the stream is closed
+    # before it starts
+    rv.call_on_close(lambda: hub.unsubscribe(subscription))
+    return rv
@@ -1,8 +1,9 @@
-from flask import request
 from . import api
 from .. import db
 from ..models import Product
 from ..decorators import json, paginate
+from ..representations import request_data
+from ..utils import check_if_match
 
 
 @api.route('/products/', methods=['GET'])
@@ -20,7 +21,7 @@ def get_product(id):
 @json
 def new_product():
     product = Product()
-    product.import_data(request.json)
+    product.import_data(request_data())
     db.session.add(product)
     db.session.commit()
     return {}, 201, {'Location': product.get_url()}
@@ -29,7 +30,8 @@ def new_product():
 @json
 def edit_product(id):
     product = Product.query.get_or_404(id)
-    product.import_data(request.json)
+    check_if_match(product)
+    product.import_data(request_data())
     db.session.add(product)
     db.session.commit()
     return {}
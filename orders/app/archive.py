@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from . import db
+from .models import Order, Item, ArchivedOrder, ArchivedItem
+
+
+def _copy(model, archive, criterion):
+    """Copy the rows of a model that match the criterion to its archive
+    table, with a single INSERT ... SELECT statement."""
+    columns = [column.key for column in model.__table__.columns]
+    db.session.execute(archive.__table__.insert().from_select(
+        columns, select([model.__table__.c[key] for key in columns])
+        .where(criterion)))
+
+
+def archive_orders(max_age, batch_size=500):
+    """Move the orders older than max_age days, along with their items, to
+    the archive tables. Each batch of orders is moved in its own
+    transaction, so the orders are always in exactly one of the two tables.
+    Returns the number of orders that were archived."""
+    before = datetime.utcnow() - timedelta(days=max_age)
+    archived = 0
+    # orders are archived within their shard
+    for shard_id in db.session().shard_ids:
+        while True:
+            ids = [id for id, in db.session.query(Order.id).set_shard(
+                shard_id).filter(Order.date < before).limit(batch_size)]
+            if not ids:
+                break
+            _copy(Order, ArchivedOrder, Order.id.in_(ids))
+            _copy(Item, ArchivedItem, Item.order_id.in_(ids))
+            # the items are deleted by the database, through the foreign key
+            archived += Order.query.filter(Order.id.in_(ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+    return archived
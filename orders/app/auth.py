@@ -1,6 +1,8 @@
-from flask import jsonify, g, current_app
+from flask import g, current_app
 from flask.ext.httpauth import HTTPBasicAuth
+from .decorators import rate_limit
 from .models import User
+from .representations import represent
 
 auth = HTTPBasicAuth()
 auth_token = HTTPBasicAuth()
@@ -15,8 +17,8 @@ def verify_password(username, password):
 
 @auth.error_handler
 def unauthorized():
-    response = jsonify({'status': 401, 'error': 'unauthorized',
-                        'message': 'please authenticate'})
+    response = represent({'status': 401, 'error': 'unauthorized',
+                          'message': 'please authenticate'})
     response.status_code = 401
     return response
 
@@ -28,9 +30,14 @@ def verify_auth_token(token, unused):
         g.user = User.verify_auth_token(token)
     return g.user is not None
 
+# requests that fail authentication are rate limited for each IP address,
+# while authenticated users are only limited for themselves, so bad clients
+# cannot use up the budget of the users that share their address
 @auth_token.error_handler
+@rate_limit(limit=250, period=15, by='ip')
 def unauthorized_token():
-    response = jsonify({'status': 401, 'error': 'unauthorized',
-                        'message': 'please send your authentication token'})
+    response = represent(
+        {'status': 401, 'error': 'unauthorized',
+         'message': 'please send your authentication token'})
     response.status_code = 401
     return response
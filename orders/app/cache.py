@@ -0,0 +1,96 @@
+import itertools
+import threading
+from collections import OrderedDict, namedtuple
+from time import time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+
+_caches = {}
+
+
+class ReferenceCache(object):
+    """Process-local read-through cache for the rows of a model that change
+    rarely but are read constantly. Rows are cached as named tuples of the
+    given columns, and the least recently used ones are evicted once there
+    are more than <PREFIX>_SIZE of them.
+
+    The changes committed through the session invalidate the rows they
+    touch. Changes made by other processes are not seen until the cached
+    row is older than <PREFIX>_TTL seconds, so multi-process deployments
+    should set a short TTL."""
+    def __init__(self, model, columns, config_prefix):
+        self.model = model
+        self.columns = columns
+        self.row = namedtuple(model.__name__ + 'Row', columns)
+        self.config_prefix = config_prefix
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()
+        self.generation = 0
+        _caches[model] = self
+
+    def get(self, id):
+        """Return the row with the given id, or None if it does not
+        exist."""
+        now = time()
+        with self.lock:
+            entry = self.rows.get(id)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self.rows.move_to_end(id)
+                return entry[0]
+            generation = self.generation
+
+        row = db.session.query(*[getattr(self.model, column)
+                                 for column in self.columns]) \
+            .filter(self.model.id == id).first()
+        if row is None:
+            return None
+        row = self.row(*row)
+
+        # rows the session changed are not cached until the changes are
+        # committed, and rows that were read while an invalidation happened
+        # may be stale
+        if (self, id) in db.session().info.get('invalidations', ()):
+            return row
+        config = current_app.config
+        size = config.get(self.config_prefix + '_SIZE', 1024)
+        ttl = config.get(self.config_prefix + '_TTL')
+        with self.lock:
+            if generation == self.generation and size:
+                self.rows[id] = (row, now + ttl if ttl else None)
+                self.rows.move_to_end(id)
+                while len(self.rows) > size:
+                    self.rows.popitem(last=False)
+        return row
+
+    def invalidate(self, id=None):
+        """Remove a row from the cache, or all the rows if no id is
+        given."""
+        with self.lock:
+            self.generation += 1
+            if id is None:
+                self.rows.clear()
+            else:
+                self.rows.pop(id, None)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_invalidations(session, flush_context):
+    """Remember the cached rows that a flush changed."""
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        cache = _caches.get(type(obj))
+        if cache is not None:
+            session.info.setdefault('invalidations', set()).add(
+                (cache, obj.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    for cache, id in session.info.pop('invalidations', ()):
+        cache.invalidate(id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_invalidations(session, previous_transaction):
+    session.info.pop('invalidations', None)
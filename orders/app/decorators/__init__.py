@@ -1,4 +1,5 @@
 from .json import json
 from .paginate import paginate
 from .caching import cache_control, no_cache, etag
-from .rate_limit import rate_limit
\ No newline at end of file
+from .rate_limit import rate_limit, rate_cost
+from .compress import compress
\ No newline at end of file
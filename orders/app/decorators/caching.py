@@ -1,6 +1,8 @@
 import functools
 import hashlib
-from flask import request, make_response, jsonify
+from flask import request, make_response
+from .. import metrics
+from ..representations import represent
 
 
 def cache_control(*directives):
@@ -36,43 +38,61 @@ def etag(f):
         rv = f(*args, **kwargs)
         rv = make_response(rv)
 
-        # etags only make sense for request that are cacheable, so only
-        # GET and HEAD requests are allowed
-        if request.method not in ['GET', 'HEAD']:
-            return rv
+        with metrics.timed('etag'):
+            # etags only make sense for request that are cacheable, so only
+            # GET and HEAD requests are allowed
+            if request.method not in ['GET', 'HEAD']:
+                return rv
 
-        # if the response is not a code 200 OK then we let it through
-        # unchanged
-        if rv.status_code != 200:
-            return rv
+            # if the response is not a code 200 OK then we let it through
+            # unchanged
+            if rv.status_code != 200:
+                return rv
 
-        # compute the etag for this request as the MD5 hash of the response
-        # text and set it in the response header
-        etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
-        rv.headers['ETag'] = etag
+            # streamed responses are not hashed, as that would require the
+            # whole response to be buffered
+            if rv.is_streamed:
+                return rv
 
-        # handle If-Match and If-None-Match request headers if present
-        if_match = request.headers.get('If-Match')
-        if_none_match = request.headers.get('If-None-Match')
-        if if_match:
-            # only return the response if the etag for this request matches
-            # any of the etags given in the If-Match header. If there is no
-            # match, then return a 412 Precondition Failed status code
-            etag_list = [tag.strip() for tag in if_match.split(',')]
-            if etag not in etag_list and '*' not in etag_list:
-                response = jsonify({'status': 412, 'error': 'precondition failed',
-                                    'message': 'precondition failed'})
-                response.status_code = 412
-                return response
-        elif if_none_match:
-            # only return the response if the etag for this request does not
-            # match any of the etags given in the If-None-Match header. If
-            # one matches, then return a 304 Not Modified status code
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
-            if etag in etag_list or '*' in etag_list:
-                response = jsonify({'status': 304, 'error': 'not modified',
-                                    'message': 'resource not modified'})
-                response.status_code = 304
-                return response
-        return rv
+            # compute the etag for this request as the MD5 hash of the
+            # response text and set it in the response header, unless the
+            # route already generated one
+            etag = rv.headers.get('ETag')
+            if etag is None:
+                etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
+                rv.headers['ETag'] = etag
+
+            # handle If-Match and If-None-Match request headers if present
+            if_match = request.headers.get('If-Match')
+            if_none_match = request.headers.get('If-None-Match')
+            if if_match:
+                # only return the response if the etag for this request
+                # matches any of the etags given in the If-Match header. If
+                # there is no match, then return a 412 Precondition Failed
+                # status code
+                etag_list = [tag.strip() for tag in if_match.split(',')]
+                if etag not in etag_list and '*' not in etag_list:
+                    response = represent({'status': 412,
+                                          'error': 'precondition failed',
+                                          'message': 'precondition failed'})
+                    response.status_code = 412
+                    return response
+            elif if_none_match:
+                # only return the response if the etag for this request does
+                # not match any of the etags given in the If-None-Match
+                # header. If one matches, then return a 304 Not Modified
+                # status code
+                etag_list = [tag.strip() for tag in if_none_match.split(',')]
+                if etag in etag_list or '*' in etag_list:
+                    response = represent({'status': 304,
+                                          'error': 'not modified',
+                                          'message': 'resource not modified'})
+                    response.status_code = 304
+                    # the headers that describe the representation are sent
+                    # as they would be in a 200 response
+                    for header in ['ETag', 'Vary', 'Cache-Control']:
+                        if header in rv.headers:
+                            response.headers[header] = rv.headers[header]
+                    return response
+            return rv
     return wrapped
@@ -0,0 +1,99 @@
+import functools
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from flask import current_app, request, make_response
+from .. import metrics
+
+# window bits for each supported content coding
+_encodings = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _compressor(encoding):
+    return zlib.compressobj(current_app.config.get('COMPRESS_LEVEL', 6),
+                            zlib.DEFLATED, _encodings[encoding])
+
+
+def _compress_stream(iterable, encoding):
+    """Compress a streamed response one chunk at a time, flushing after each
+    chunk so that the client does not have to wait for the whole body."""
+    compressor = _compressor(encoding)
+    for chunk in iterable:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        yield compressor.compress(chunk) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _compress_body(data, encoding):
+    """Compress a response body, reusing the result of a previous
+    compression of the same body when it is still in the cache."""
+    cache_size = current_app.config.get('COMPRESS_CACHE_SIZE', 128)
+    key = (encoding, hashlib.md5(data).digest())
+    with _cache_lock:
+        compressed = _cache.get(key)
+        if compressed is not None:
+            _cache.move_to_end(key)
+            return compressed
+    compressor = _compressor(encoding)
+    compressed = compressor.compress(data) + compressor.flush()
+    if cache_size:
+        with _cache_lock:
+            _cache[key] = compressed
+            while len(_cache) > cache_size:
+                _cache.popitem(last=False)
+    return compressed
+
+
+def compress(f):
+    """Compress the response with gzip or deflate when the client accepts
+    it. Bodies smaller than the COMPRESS_MIN_SIZE configuration setting are
+    sent uncompressed."""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        # invoke the wrapped function and generate a response object from
+        # its result
+        rv = f(*args, **kwargs)
+        rv = make_response(rv)
+
+        with metrics.timed('compress'):
+            # responses without a body or that are already encoded are sent
+            # as they are
+            if rv.status_code < 200 or rv.status_code in [204, 304] or \
+                    'Content-Encoding' in rv.headers or \
+                    rv.direct_passthrough or request.method == 'HEAD':
+                return rv
+
+            # the representation depends on the Accept-Encoding header, so
+            # caches need to know about it even if this response is not
+            # compressed
+            rv.vary.add('Accept-Encoding')
+            encoding = request.accept_encodings.best_match(
+                ['gzip', 'deflate'])
+            if encoding is None:
+                return rv
+
+            if rv.is_streamed:
+                # the length of a streamed response is not known in advance,
+                # so it is always compressed
+                rv.response = _compress_stream(rv.response, encoding)
+                del rv.headers['Content-Length']
+            else:
+                data = rv.get_data()
+                if len(data) < current_app.config.get('COMPRESS_MIN_SIZE',
+                                                      500):
+                    return rv
+                rv.set_data(_compress_body(data, encoding))
+            rv.headers['Content-Encoding'] = encoding
+
+            # an etag that was generated for the uncompressed body needs to
+            # be changed to represent this encoding
+            if 'ETag' in rv.headers:
+                etag, weak = rv.get_etag()
+                rv.set_etag(etag + '-' + encoding, weak)
+            return rv
+    return wrapped
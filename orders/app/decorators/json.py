@@ -1,5 +1,6 @@
 import functools
-from flask import jsonify
+from .. import metrics
+from ..representations import represent
 
 
 def json(f):
@@ -10,26 +11,38 @@ def json(f):
         # invoke the wrapped function
         rv = f(*args, **kwargs)
 
-        # the wrapped function can return the dictionary alone,
-        # or can also include a status code and/or headers.
-        # here we separate all these items
-        status = None
-        headers = None
-        if isinstance(rv, tuple):
-            rv, status, headers = rv + (None,) * (3 - len(rv))
-        if isinstance(status, (dict, list)):
-            headers, status = status, None
+        with metrics.timed('json'):
+            # the wrapped function can return the dictionary alone,
+            # or can also include a status code and/or headers.
+            # here we separate all these items
+            status = None
+            headers = None
+            if isinstance(rv, tuple):
+                rv, status, headers = rv + (None,) * (3 - len(rv))
+            if isinstance(status, (dict, list)):
+                headers, status = status, None
 
-        # if the response was a database model, then convert it to a
-        # dictionary
-        if not isinstance(rv, dict):
-            rv = rv.export_data()
+            # if the response was a database model, then convert it to a
+            # dictionary
+            version = None
+            if not isinstance(rv, dict):
+                version = getattr(rv, 'version', None)
+                rv = rv.export_data()
 
-        # generate the JSON response
-        rv = jsonify(rv)
-        if status is not None:
-            rv.status_code = status
-        if headers is not None:
-            rv.headers.extend(headers)
-        return rv
+            # generate the response in the format requested by the client
+            rv = represent(rv)
+            if status is not None:
+                rv.status_code = status
+            if headers is not None:
+                rv.headers.extend(headers)
+
+            # versioned resources get an etag generated from the version,
+            # with a suffix for representations other than JSON
+            if version is not None and rv.status_code == 200:
+                if rv.mimetype == 'application/json':
+                    rv.set_etag(str(version))
+                else:
+                    rv.set_etag('{0}-{1}'.format(
+                        version, rv.mimetype.split('/')[-1]))
+            return rv
     return wrapped
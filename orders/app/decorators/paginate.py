@@ -1,5 +1,8 @@
 import functools
 from flask import url_for, request
+from .. import metrics
+from ..serializers import get_serializer
+from .rate_limit import rate_cost
 
 
 def paginate(collection, max_per_page=25):
@@ -11,55 +14,86 @@ def paginate(collection, max_per_page=25):
     The output of this decorator is a Python dictionary with the paginated
     results. The application must ensure that this result is converted to a
     response object, either by chaining another decorator or by using a
-    custom response object that accepts dictionaries."""
+    custom response object that accepts dictionaries.
+
+    For the rate limiter, an expanded page costs as much as one request per
+    resource in it, and a page of URLs as much as a single request."""
+    def page_cost():
+        if request.args.get('expanded', 0, type=int) == 0:
+            return 1
+        return max(min(request.args.get('per_page', max_per_page, type=int),
+                       max_per_page), 1)
+
     def decorator(f):
+        @rate_cost(page_cost)
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
             # invoke the wrapped function
             query = f(*args, **kwargs)
 
-            # obtain pagination arguments from the URL's query string
-            page = request.args.get('page', 1, type=int)
-            per_page = min(request.args.get('per_page', max_per_page,
-                                            type=int), max_per_page)
-            expanded = None
-            if request.args.get('expanded', 0, type=int) != 0:
-                expanded = 1
+            with metrics.timed('paginate'):
+                # obtain pagination arguments from the URL's query string
+                page = request.args.get('page', 1, type=int)
+                per_page = min(request.args.get('per_page', max_per_page,
+                                                type=int), max_per_page)
+                expanded = None
+                if request.args.get('expanded', 0, type=int) != 0:
+                    expanded = 1
 
-            # run the query with Flask-SQLAlchemy's pagination
-            p = query.paginate(page, per_page)
+                # models that have a serializer are queried as row tuples
+                # with just the columns that are needed, which is much
+                # cheaper than loading full model instances
+                serializer = get_serializer(
+                    query.column_descriptions[0]['type'])
+                if serializer is not None:
+                    if expanded:
+                        query = serializer.query(query)
+                    else:
+                        query = serializer.url_query(query)
 
-            # build the pagination metadata to include in the response
-            pages = {'page': page, 'per_page': per_page,
-                     'total': p.total, 'pages': p.pages}
-            if p.has_prev:
-                pages['prev_url'] = url_for(request.endpoint, page=p.prev_num,
-                                            per_page=per_page,
-                                            expanded=expanded, _external=True,
-                                            **kwargs)
-            else:
-                pages['prev_url'] = None
-            if p.has_next:
-                pages['next_url'] = url_for(request.endpoint, page=p.next_num,
+                # run the query with Flask-SQLAlchemy's pagination
+                p = query.paginate(page, per_page)
+
+                # build the pagination metadata to include in the response
+                pages = {'page': page, 'per_page': per_page,
+                         'total': p.total, 'pages': p.pages}
+                if p.has_prev:
+                    pages['prev_url'] = url_for(request.endpoint,
+                                                page=p.prev_num,
+                                                per_page=per_page,
+                                                expanded=expanded,
+                                                _external=True, **kwargs)
+                else:
+                    pages['prev_url'] = None
+                if p.has_next:
+                    pages['next_url'] = url_for(request.endpoint,
+                                                page=p.next_num,
+                                                per_page=per_page,
+                                                expanded=expanded,
+                                                _external=True, **kwargs)
+                else:
+                    pages['next_url'] = None
+                pages['first_url'] = url_for(request.endpoint, page=1,
+                                             per_page=per_page,
+                                             expanded=expanded,
+                                             _external=True, **kwargs)
+                pages['last_url'] = url_for(request.endpoint, page=p.pages,
                                             per_page=per_page,
-                                            expanded=expanded, _external=True,
-                                            **kwargs)
-            else:
-                pages['next_url'] = None
-            pages['first_url'] = url_for(request.endpoint, page=1,
-                                         per_page=per_page, expanded=expanded,
-                                         _external=True, **kwargs)
-            pages['last_url'] = url_for(request.endpoint, page=p.pages,
-                                        per_page=per_page, expanded=expanded,
-                                        _external=True, **kwargs)
+                                            expanded=expanded,
+                                            _external=True, **kwargs)
 
-            # generate the paginated collection as a dictionary
-            if expanded:
-                results = [item.export_data() for item in p.items]
-            else:
-                results = [item.get_url() for item in p.items]
+                # generate the paginated collection as a dictionary
+                if serializer is not None:
+                    if expanded:
+                        results = serializer.dump(p.items)
+                    else:
+                        results = serializer.dump_urls(p.items)
+                elif expanded:
+                    results = [item.export_data() for item in p.items]
+                else:
+                    results = [item.get_url() for item in p.items]
 
-            # return a dictionary as a response
-            return {collection: results, 'pages': pages}
+                # return a dictionary as a response
+                return {collection: results, 'pages': pages}
         return wrapped
     return decorator
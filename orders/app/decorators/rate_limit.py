@@ -1,53 +1,106 @@
 import functools
+import math
+import threading
 from time import time
-from flask import current_app, request, g, jsonify
+from flask import current_app, request, g
+from ..representations import represent
 
 _limiter = None
 
 
 class MemRateLimit(object):
-    """Rate limiter that uses a Python dictionary as storage."""
-    def __init__(self):
-        self.counters = {}
-
-    def is_allowed(self, key, limit, period):
-        """Check if the client's request should be allowed, based on the
-        hit counter. Returns a 3-element tuple with a True/False result,
-        the number of remaining hits in the period, and the time the
-        counter resets for the next period."""
-        now = int(time())
-        begin_period = now // period * period
-        end_period = begin_period + period
-
-        self.cleanup(now)
-        if key in self.counters:
-            self.counters[key]['hits'] += 1
-        else:
-            self.counters[key] = {'hits': 1, 'reset': end_period}
-        allow = True
-        remaining = limit - self.counters[key]['hits']
-        if remaining < 0:
-            remaining = 0
-            allow = False
-        return allow, remaining, self.counters[key]['reset']
+    """Rate limiter that implements the generic cell rate algorithm (GCRA)
+    with a Python dictionary as storage. For each key it only stores the
+    theoretical arrival time, the time at which the client's bucket will be
+    full again. Clients can send bursts of up to 'limit' requests, and then
+    one more request every 'period' / 'limit' seconds, so there are no
+    window boundaries that allow double bursts."""
+    def __init__(self, cleanup_interval=60):
+        self.tats = {}
+        self.lock = threading.Lock()
+        self.cleanup_interval = cleanup_interval
+        self.next_cleanup = 0
+
+    def is_allowed(self, key, limit, period, cost=1):
+        """Check if the client's request should be allowed, and charge its
+        cost, given in requests, if it is. Returns a 4-element tuple with a
+        True/False result, the number of requests remaining, the time at
+        which the client can send 'limit' requests again, and the number of
+        seconds the client needs to wait before it can retry the request,
+        or 0 if the request was allowed."""
+        now = time()
+        interval = float(period) / limit
+        # a request that costs more than the limit could never be allowed,
+        # so it takes all the requests available in a period
+        cost = min(cost, limit)
+
+        with self.lock:
+            self.cleanup(now)
+            tat = max(self.tats.get(key, now), now)
+            new_tat = tat + cost * interval
+            allow_at = new_tat - period
+            if now < allow_at:
+                retry_after = allow_at - now
+            else:
+                retry_after = 0
+                tat = self.tats[key] = new_tat
+        remaining = int((period - (tat - now)) / interval + 1e-9)
+        return retry_after == 0, remaining, int(math.ceil(tat)), \
+            int(math.ceil(retry_after))
 
     def cleanup(self, now):
-        """Eliminate expired keys."""
-        for key, value in list(self.counters.items()):
-            if value['reset'] < now:
-                del self.counters[key]
+        """Eliminate the keys of clients whose bucket is full again, which
+        are the same as keys that do not exist."""
+        if now < self.next_cleanup:
+            return
+        for key, tat in list(self.tats.items()):
+            if tat <= now:
+                del self.tats[key]
+        self.next_cleanup = now + self.cleanup_interval
+
+
+def rate_cost(cost):
+    """Declare the cost of a route for the rate limiter, in requests. The
+    cost can be a number, or a function that calculates it from the
+    request."""
+    def decorator(f):
+        f.rate_cost = cost
+        return f
+    return decorator
 
 
-def rate_limit(limit, period):
+def rate_limit(limit, period, cost=1, by='user'):
     """Limits the rate at which clients can send requests to 'limit' requests
-    per 'period' seconds. Once a client goes over the limit all requests are
-    answered with a status code 429 Too Many Requests for the remaining of
-    that period."""
+    per 'period' seconds. Clients are identified by the authenticated user,
+    or by their IP address when there is no user. Routes that are more
+    expensive than others can declare a higher cost with the rate_cost
+    decorator, and the cost argument gives the cost of routes that do not.
+
+    With by='ip' clients are always identified by their IP address, and
+    each request costs the cost argument, regardless of the route. This is
+    used to limit requests that fail authentication, so that clients with
+    bad credentials are also limited.
+
+    When this decorator is used in a blueprint's before_request handler, the
+    limits apply to each route of the blueprint, and they can be changed
+    without touching the code with the RATE_LIMITS configuration setting, a
+    dictionary that maps blueprint names or endpoints to (limit, period)
+    tuples. Routes that have their own limits are counted separately. The
+    limits by IP address are configured with the same keys followed by
+    ':ip'.
+
+    Once a client goes over the limit its requests are answered with a
+    status code 429 Too Many Requests, and a Retry-After header with the
+    number of seconds until the request would be allowed."""
     def decorator(f):
+        scope = '{0}.{1}'.format(f.__module__, f.__name__)
+        suffix = ':ip' if by == 'ip' else ''
+
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
-            if current_app.config['TESTING']:
-                # no rate limiting for debug and testing configurations
+            if not current_app.config.get('RATE_LIMIT_ENABLED',
+                                          not current_app.config['TESTING']):
+                # no rate limiting for testing configurations
                 return f(*args, **kwargs)
             else:
                 # initialize the rate limiter the first time here
@@ -55,28 +108,52 @@ def rate_limit(limit, period):
                 if _limiter is None:
                     _limiter = MemRateLimit()
 
-                # generate a unique key to represent the decorated function and
-                # the IP address of the client. Rate limiting counters are
-                # maintained on each unique key.
-                key = '{0}/{1}'.format(f.__name__, request.remote_addr)
-                allowed, remaining, reset = _limiter.is_allowed(key, limit,
-                                                                period)
+                # find the limits and the cost of the route
+                route_limit, route_period, bucket = limit, period, scope
+                limits = current_app.config.get('RATE_LIMITS', {})
+                endpoint = '{0}{1}'.format(request.endpoint, suffix)
+                blueprint = '{0}{1}'.format(request.blueprint, suffix)
+                if endpoint in limits:
+                    route_limit, route_period = limits[endpoint]
+                    bucket = request.endpoint
+                elif blueprint in limits:
+                    route_limit, route_period = limits[blueprint]
+                route_cost = cost
+                if by != 'ip':
+                    view = current_app.view_functions.get(request.endpoint)
+                    route_cost = getattr(view, 'rate_cost', cost)
+                if callable(route_cost):
+                    route_cost = route_cost()
+
+                # rate limiting counters are maintained for each user, or
+                # for each IP address for requests without a user
+                user = getattr(g, 'user', None) if by != 'ip' else None
+                if user is not None:
+                    client = 'user:{0}'.format(user.id)
+                else:
+                    client = 'ip:{0}'.format(request.remote_addr)
+                key = '{0}/{1}'.format(bucket, client)
+                allowed, remaining, reset, retry_after = _limiter.is_allowed(
+                    key, route_limit, route_period, route_cost)
 
                 # set the rate limit headers in g, so that they are picked up
-                # by the after_request handler and attached to the response
+                # by the after_request handler and attached to the response.
+                # When several limits apply, the last one that the request
+                # went through is reported
                 g.headers = {
                     'X-RateLimit-Remaining': str(remaining),
-                    'X-RateLimit-Limit': str(limit),
+                    'X-RateLimit-Limit': str(route_limit),
                     'X-RateLimit-Reset': str(reset)
                 }
 
                 # if the client went over the limit respond with a 429 status
                 # code, else invoke the wrapped function
                 if not allowed:
-                    response = jsonify(
+                    response = represent(
                         {'status': 429, 'error': 'too many requests',
                          'message': 'You have exceeded your request rate'})
                     response.status_code = 429
+                    response.headers['Retry-After'] = str(retry_after)
                     return response
 
                 # else we let the request through
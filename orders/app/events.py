@@ -0,0 +1,107 @@
+import queue
+import threading
+from time import time
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session
+from . import db
+from .models import Change
+
+
+class Subscription(object):
+    """Bounded queue of the events delivered to one subscriber. When the
+    queue fills up the subscription is marked as overflowed and receives no
+    more events, so that a slow client cannot make the server buffer an
+    unlimited number of events."""
+    def __init__(self, hub, models, maxsize):
+        self.hub = hub
+        self.models = models
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Return the next event, or None if there is none before the
+        timeout."""
+        if self.hub.sleep is None:
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        # in the asynchronous mode waits must yield to other greenlets, so
+        # the queue is polled
+        deadline = time() + timeout
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                if time() >= deadline:
+                    return None
+                self.hub.sleep(self.hub.poll_interval)
+
+
+class EventHub(object):
+    """In-process publish/subscribe hub for the changes written to the change
+    log. After each commit that changed resources, the new entries of the
+    change log are read once and delivered to all the subscribers."""
+    def __init__(self, sleep=None, poll_interval=0.05):
+        self.sleep = sleep
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.last_seq = None
+
+    def subscribe(self, models, maxsize=100):
+        """Create a subscription to the changes of the given models."""
+        subscription = Subscription(self, models, maxsize)
+        with self.lock:
+            if self.last_seq is None:
+                # changes are not tracked while there are no subscribers, so
+                # they start from the current end of the change log
+                self.last_seq = db.engine.execute(
+                    select([func.max(Change.seq)])).scalar() or 0
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            if not self.subscriptions:
+                self.last_seq = None
+
+    def publish(self):
+        """Deliver the changes committed since the last call."""
+        with self.lock:
+            if not self.subscriptions:
+                return
+            changes = db.engine.execute(
+                select([Change.__table__])
+                .where(Change.seq > self.last_seq)
+                .order_by(Change.seq)).fetchall()
+            for change in changes:
+                for subscription in self.subscriptions:
+                    if change.model in subscription.models and \
+                            not subscription.overflowed:
+                        subscription.put(change)
+                self.last_seq = change.seq
+
+
+hub = EventHub()
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_changes(session):
+    # the session cannot issue queries at this point, so the hub reads the
+    # new changes on its own connection
+    if session.info.pop('changes', False):
+        hub.publish()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_changes(session, previous_transaction):
+    session.info.pop('changes', None)
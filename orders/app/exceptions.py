@@ -2,3 +2,5 @@ class ValidationError(ValueError):
     pass
 
 
+class PreconditionFailed(Exception):
+    pass
@@ -0,0 +1,152 @@
+from bisect import bisect_left
+from time import perf_counter
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_metrics = []
+_sql_events_installed = False
+
+
+class Counter(object):
+    """Counter metric, with a value for each combination of labels. Updates
+    are plain dictionary operations that do not take any locks, so under
+    heavy contention an occasional increment can be lost."""
+    type = 'counter'
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values):
+        self.values[label_values] = self.values.get(label_values, 0) + 1
+
+    def render(self):
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, self.labels, label_values, value
+
+
+class Histogram(object):
+    """Histogram metric, with a set of buckets for each combination of
+    labels. Like counters, histograms are updated without locking."""
+    type = 'histogram'
+
+    def __init__(self, name, description, labels,
+                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                          0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        # each entry holds the count of each bucket, plus one for values
+        # above the last bucket, followed by the sum of all the values
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values.setdefault(
+                label_values, [0] * (len(self.buckets) + 1) + [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        labels = self.labels + ('le',)
+        for label_values, counts in sorted(self.values.items()):
+            total = 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield (self.name + '_bucket', labels,
+                       label_values + (str(le),), total)
+            yield self.name + '_sum', self.labels, label_values, counts[-1]
+            yield self.name + '_count', self.labels, label_values, total
+
+
+class timed(object):
+    """Context manager that records the time spent in its block in the
+    decorator duration histogram."""
+    def __init__(self, decorator):
+        self.decorator = decorator
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *args):
+        decorator_duration.observe(perf_counter() - self.start,
+                                   self.decorator)
+
+
+requests_total = Counter(
+    'http_requests_total', 'Number of requests handled.',
+    ('endpoint', 'method', 'status'))
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests.',
+    ('endpoint',))
+sql_statements = Histogram(
+    'sql_statements_per_request', 'Number of SQL statements per request.',
+    ('endpoint',), buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+sql_duration = Histogram(
+    'sql_duration_seconds', 'Time spent running SQL statements per request.',
+    ('endpoint',))
+decorator_duration = Histogram(
+    'decorator_duration_seconds', 'Time spent in the response decorators.',
+    ('decorator',))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['query_start'] = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    if has_request_context() and hasattr(g, 'sql_count'):
+        g.sql_count += 1
+        g.sql_time += perf_counter() - conn.info.pop('query_start')
+
+
+def start_request():
+    """Start the measurements for a request."""
+    g.request_start = perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+
+def finish_request(response):
+    """Record the measurements of a finished request."""
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return
+    endpoint = request.endpoint or 'none'
+    request_duration.observe(perf_counter() - start, endpoint)
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+    sql_statements.observe(g.sql_count, endpoint)
+    sql_duration.observe(g.sql_time, endpoint)
+
+
+def render():
+    """Return all the metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+        for name, labels, label_values, value in metric.render():
+            lines.append('{0}{{{1}}} {2}'.format(
+                name, ','.join('{0}="{1}"'.format(label, label_value)
+                               for label, label_value in zip(labels,
+                                                             label_values)),
+                value))
+    return '\n'.join(lines) + '\n'
+
+
+def install_sql_events():
+    """Attach the SQL statement counters to all database engines."""
+    global _sql_events_installed
+    if not _sql_events_installed:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _sql_events_installed = True
@@ -4,9 +4,14 @@ from dateutil.tz import tzutc
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import url_for, current_app
+from sqlalchemy import event, select, literal
+from sqlalchemy.orm import Session
 from . import db
 from .exceptions import ValidationError
 from .utils import split_url
+from .serializers import register, get_serializer, url_builder
+from .shards import route
+from .cache import ReferenceCache
 
 
 class User(db.Model):
@@ -16,7 +21,9 @@ class User(db.Model):
     password_hash = db.Column(db.String(128))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(
+            password, current_app.config.get('PASSWORD_HASH_METHOD',
+                                             'pbkdf2:sha1'))
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -37,9 +44,13 @@ class User(db.Model):
 
 class Customer(db.Model):
     __tablename__ = 'customers'
+    __table_args__ = {'info': {'sharded': True},
+                      'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)
     orders = db.relationship('Order', backref='customer', lazy='dynamic')
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
 
     def get_url(self):
         return url_for('api.get_customer', id=self.id, _external=True)
@@ -62,9 +73,12 @@ class Customer(db.Model):
 
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = {'info': {'replicated': True}}
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)
     items = db.relationship('Item', backref='product', lazy='dynamic')
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
 
     def get_url(self):
         return url_for('api.get_product', id=self.id, _external=True)
@@ -83,14 +97,24 @@ class Product(db.Model):
         return self
 
 
+# products are referenced by every item, but rarely change
+product_cache = ReferenceCache(Product, ['id', 'name', 'version'],
+                               'PRODUCT_CACHE')
+
+
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = {'info': {'sharded': True},
+                      'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'),
                             index=True)
     date = db.Column(db.DateTime, default=datetime.now)
     items = db.relationship('Item', backref='order', lazy='dynamic',
-                            cascade='all, delete-orphan')
+                            cascade='all, delete-orphan',
+                            passive_deletes=True)
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
 
     def get_url(self):
         return url_for('api.get_order', id=self.id, _external=True)
@@ -115,11 +139,17 @@ class Order(db.Model):
 
 class Item(db.Model):
     __tablename__ = 'items'
+    __table_args__ = {'info': {'sharded': True},
+                      'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
+    order_id = db.Column(db.Integer,
+                         db.ForeignKey('orders.id', ondelete='CASCADE'),
+                         index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'),
                            index=True)
     quantity = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
 
     def get_url(self):
         return url_for('api.get_item', id=self.id, _external=True)
@@ -128,7 +158,8 @@ class Item(db.Model):
         return {
             'self_url': self.get_url(),
             'order_url': self.order.get_url(),
-            'product_url': self.product.get_url(),
+            'product_url': url_for('api.get_product', id=self.product_id,
+                                   _external=True),
             'quantity': self.quantity
         }
 
@@ -141,8 +172,133 @@ class Item(db.Model):
         if endpoint != 'api.get_product' or not 'id' in args:
             raise ValidationError('Invalid product URL: ' +
                                   data['product_url'])
-        self.product = Product.query.get(args['id'])
-        if self.product is None:
+        product = product_cache.get(args['id'])
+        if product is None:
             raise ValidationError('Invalid product URL: ' +
                                   data['product_url'])
+        self.product_id = product.id
         return self
+
+
+class ArchivedOrder(db.Model):
+    """Order that was moved out of the orders table by the archival job.
+    Archived orders keep their ids, and are represented exactly like the
+    orders in the orders table."""
+    __tablename__ = 'archived_orders'
+    __table_args__ = {'info': {'sharded': True}}
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'),
+                            index=True)
+    date = db.Column(db.DateTime)
+    customer = db.relationship('Customer')
+    items = db.relationship('ArchivedItem', backref='order', lazy='dynamic')
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
+
+    get_url = Order.get_url
+    export_data = Order.export_data
+
+
+class ArchivedItem(db.Model):
+    """Item of an archived order."""
+    __tablename__ = 'archived_items'
+    __table_args__ = {'info': {'sharded': True}}
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('archived_orders.id'),
+                         index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'),
+                           index=True)
+    quantity = db.Column(db.Integer)
+    product = db.relationship('Product')
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
+
+    get_url = Item.get_url
+    export_data = Item.export_data
+
+
+class Change(db.Model):
+    """Append-only log of the changes made to the resources of the API,
+    written in the same transaction as the changes themselves."""
+    __tablename__ = 'changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(64))
+    resource_id = db.Column(db.Integer)
+    operation = db.Column(db.String(16))
+    date = db.Column(db.DateTime, default=datetime.now)
+
+    def export_data(self):
+        endpoint = get_serializer(self.model).endpoint
+        return {
+            'seq': self.seq,
+            'url': url_builder(endpoint)(self.resource_id),
+            'operation': self.operation,
+            'date': self.date.isoformat() + 'Z'
+        }
+
+
+def record_deletes(session, model, criterion):
+    """Add an entry to the change log for each resource of the given model
+    that matches the criterion, with a single INSERT ... SELECT statement.
+    This is used for resources that are deleted by the database, which the
+    session never loads."""
+    columns = ['model', 'resource_id', 'operation', 'date']
+    rows = select([literal(model.__name__), model.id, literal('delete'),
+                   literal(datetime.now())]).where(criterion)
+    if route(rows) != set([0]):
+        # the resources are in a different database than the change log
+        changes = [dict(zip(columns, row))
+                   for row in session.execute(rows).fetchall()]
+        if changes:
+            session.execute(Change.__table__.insert(), changes)
+    else:
+        session.execute(Change.__table__.insert().from_select(columns,
+                                                              rows))
+    session.info['changes'] = True
+
+
+@event.listens_for(Session, 'before_flush')
+def record_cascaded_deletes(session, flush_context, instances):
+    """Log the deletes that the database cascades to the children of the
+    resources deleted by a flush."""
+    for obj in session.deleted:
+        for rel in type(obj).__mapper__.relationships:
+            if rel.passive_deletes and rel.cascade.delete and \
+                    get_serializer(rel.mapper.class_) is not None:
+                fk = list(rel.remote_side)[0]
+                record_deletes(session, rel.mapper.class_, fk == obj.id)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_changes(session, flush_context):
+    """Add an entry to the change log for each resource created, updated
+    or deleted by a flush."""
+    changes = []
+    for operation, objects in [('create', session.new),
+                               ('update', session.dirty),
+                               ('delete', session.deleted)]:
+        for obj in objects:
+            if get_serializer(type(obj)) is None:
+                continue
+            if operation == 'update' and not session.is_modified(
+                    obj, include_collections=False):
+                # only changes to the resource's own columns are logged
+                continue
+            changes.append({'model': type(obj).__name__,
+                            'resource_id': obj.id,
+                            'operation': operation})
+    if changes:
+        session.execute(Change.__table__.insert(), changes)
+        session.info['changes'] = True
+
+
+# serializers used to render collections of resources from row tuples
+register(Customer, 'api.get_customer',
+         {'orders_url': 'api.get_customer_orders'})
+register(Product, 'api.get_product')
+register(Order, 'api.get_order', {'items_url': 'api.get_order_items'})
+register(Item, 'api.get_item')
+register(ArchivedOrder, 'api.get_order',
+         {'items_url': 'api.get_order_items'})
+register(ArchivedItem, 'api.get_item')
@@ -0,0 +1,74 @@
+import json
+from collections import OrderedDict
+from flask import request, jsonify, current_app
+from .exceptions import ValidationError
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# JSON encoders that can be selected with the JSON_ENCODER configuration
+# setting. Without this setting Flask's jsonify() is used.
+_json_encoders = {
+    'json': lambda data: json.dumps(data, separators=(',', ':')).encode()}
+if ujson is not None:
+    _json_encoders['ujson'] = lambda data: ujson.dumps(
+        data, escape_forward_slashes=False).encode()
+if orjson is not None:
+    _json_encoders['orjson'] = orjson.dumps
+
+# encoders and decoders for each supported media type. JSON is listed first,
+# so that it is used when the client does not have a preference.
+_formats = OrderedDict()
+_formats['application/json'] = (None, None)
+if msgpack is not None:
+    _formats['application/msgpack'] = (
+        lambda data: msgpack.packb(data, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False))
+    _formats['application/x-msgpack'] = _formats['application/msgpack']
+if cbor2 is not None:
+    _formats['application/cbor'] = (cbor2.dumps, cbor2.loads)
+
+
+def represent(data):
+    """Generate a response with the given dictionary, encoded in the format
+    requested by the client in the Accept header. This function is a drop-in
+    replacement for Flask's jsonify()."""
+    mimetype = request.accept_mimetypes.best_match(list(_formats))
+    encode = _formats.get(mimetype, (None, None))[0]
+    if encode is None:
+        # an encoder that is configured but not installed falls back to
+        # jsonify()
+        encode = _json_encoders.get(current_app.config.get('JSON_ENCODER'))
+        mimetype = 'application/json'
+    if encode is None:
+        rv = jsonify(data)
+    else:
+        rv = current_app.response_class(encode(data), mimetype=mimetype)
+    rv.vary.add('Accept')
+    return rv
+
+
+def request_data():
+    """Return the body of the request, decoded according to its Content-Type
+    header. This function is a replacement for Flask's request.json."""
+    decode = _formats.get(request.mimetype, (None, None))[1]
+    if decode is None:
+        return request.json
+    try:
+        return decode(request.get_data())
+    except Exception:
+        raise ValidationError('Invalid ' + request.mimetype + ' body')
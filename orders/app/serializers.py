@@ -0,0 +1,117 @@
+from flask import request, url_for
+from sqlalchemy import DateTime
+
+_serializers = {}
+_url_templates = {}
+_sentinel_id = 987654321
+
+
+def url_builder(endpoint, **kwargs):
+    """Return a function that generates the external URL of the given
+    endpoint for a resource id. The path of the URL is generated once with
+    url_for() and then reused as a template, which is much faster than
+    calling url_for() for every resource. The host comes from the current
+    request, so that clients cannot grow the cache by sending requests with
+    different Host headers."""
+    key = (endpoint, tuple(sorted(kwargs.items())))
+    template = _url_templates.get(key)
+    if template is None:
+        path = url_for(endpoint, id=_sentinel_id, **kwargs)
+        template = _url_templates[key] = path.split(str(_sentinel_id), 1)
+    prefix, suffix = template
+    prefix = request.host_url[:-1] + prefix
+    return lambda id: prefix + str(id) + suffix
+
+
+class Serializer(object):
+    """Serializer for the rows of a model, compiled from the model's column
+    metadata. The primary key is rendered as self_url, foreign keys as the
+    URL of the referenced resource, and all other columns as values. The
+    urls argument adds URLs of related collections, as a dictionary of field
+    names and endpoints."""
+    def __init__(self, model, endpoint, urls=None):
+        self.model = model
+        self.endpoint = endpoint
+        self.urls = urls or {}
+        self.columns = None
+        self.fields = None
+
+    def compile(self):
+        """Generate the list of columns to query and the rules to build each
+        field from them. This happens on first use, once all the models are
+        registered."""
+        if self.fields is not None:
+            return
+        columns = []
+        fields = []
+        version_column = self.model.__mapper__.version_id_col
+        for column in self.model.__table__.columns:
+            if column is version_column:
+                # versions are only used to generate etags
+                continue
+            attr = getattr(self.model, column.key)
+            if column.primary_key:
+                columns.insert(0, attr)
+                fields.append(('self_url', self.endpoint, None))
+                fields.extend((name, endpoint, None)
+                              for name, endpoint in self.urls.items())
+                continue
+            columns.append(attr)
+            if column.foreign_keys:
+                table = next(iter(column.foreign_keys)).column.table
+                target = [s for s in _serializers.values()
+                          if s.model.__table__ is table][0]
+                name = column.key[:-3] if column.key.endswith('_id') \
+                    else column.key
+                fields.append((name + '_url', target.endpoint,
+                               len(columns) - 1))
+            elif isinstance(column.type, DateTime):
+                fields.append((column.key, lambda value:
+                               value.isoformat() + 'Z', len(columns) - 1))
+            else:
+                fields.append((column.key, None, len(columns) - 1))
+        # fields is what marks the serializer as compiled, so it is set last
+        # for concurrent requests to never see it without the columns
+        self.columns = columns
+        # fields that refer to the primary key use index 0
+        self.fields = [(name, conv, 0 if index is None else index)
+                       for name, conv, index in fields]
+
+    def query(self, query):
+        """Return a query for the rows of the given model query, as tuples
+        of just the columns that the serializer needs."""
+        self.compile()
+        return query.with_entities(*self.columns)
+
+    def url_query(self, query):
+        """Return a query for the primary keys of the given model query."""
+        self.compile()
+        return query.with_entities(self.columns[0])
+
+    def dump(self, rows):
+        """Serialize a list of row tuples into a list of dictionaries."""
+        self.compile()
+        rules = []
+        for name, conv, index in self.fields:
+            if isinstance(conv, str):
+                conv = url_builder(conv)
+            rules.append((name, conv, index))
+        return [{name: row[index] if conv is None else conv(row[index])
+                 for name, conv, index in rules} for row in rows]
+
+    def dump_urls(self, rows):
+        """Serialize a list of primary key tuples into a list of URLs."""
+        build = url_builder(self.endpoint)
+        return [build(row[0]) for row in rows]
+
+
+def register(model, endpoint, urls=None):
+    """Register a serializer for a model."""
+    _serializers[model] = _serializers[model.__name__] = \
+        Serializer(model, endpoint, urls)
+
+
+def get_serializer(model):
+    """Return the serializer registered for a model, given as a class or as
+    a class name, or None."""
+    return _serializers.get(model)
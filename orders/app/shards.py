@@ -0,0 +1,460 @@
+import itertools
+from functools import partial
+from flask import abort
+from flask.ext.sqlalchemy import SQLAlchemy, BaseQuery, Pagination, \
+    _SignallingSession
+from sqlalchemy import event, exc, func, orm, select, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import table, column
+from sqlalchemy.orm import Session, loading, class_mapper
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, \
+    BooleanClauseList, ClauseList, Grouping
+from sqlalchemy.sql.selectable import Alias, CompoundSelect, Select
+from sqlalchemy.sql.util import find_tables
+
+# each shard allocates ids from its own range, so the shard that holds a row
+# can be found from the row's id alone; shard ids are kept below 2**53, the
+# largest integer JavaScript clients can represent exactly
+SHARD_BITS = 40
+
+# databases that the ids of the shards can be set up for, and whether they
+# support two-phase commits
+_dialects = {'sqlite': False, 'postgresql': True, 'mysql': True}
+
+
+def shard_for_id(id):
+    """Return the shard that holds the row with the given id."""
+    return int(id) >> SHARD_BITS
+
+
+def shard_bind(shard_id):
+    """Return the bind key of a shard. The first shard is the application's
+    main database, which has no bind key."""
+    return 'shard{0}'.format(shard_id) if shard_id else None
+
+
+def _is_sharded(tables):
+    return any(t.info.get('sharded') for t in tables)
+
+
+def _is_id_column(col):
+    """Ids of sharded rows, and foreign keys that point to them, determine
+    the shard of a row."""
+    table = getattr(col, 'table', None)
+    if table is None or not table.info.get('sharded'):
+        return False
+    return col.primary_key or any(fk.column.table.info.get('sharded')
+                                  for fk in col.foreign_keys)
+
+
+def _route_comparison(clause, params):
+    if clause.operator is operators.eq:
+        if _is_id_column(clause.left):
+            values = [clause.right]
+        elif _is_id_column(clause.right):
+            values = [clause.left]
+        else:
+            return None
+    elif clause.operator is operators.in_op and \
+            _is_id_column(clause.left):
+        values = clause.right
+        if isinstance(values, Grouping):
+            values = values.element
+        if not isinstance(values, ClauseList):
+            return None
+        values = values.clauses
+    else:
+        return None
+    shards = set()
+    for value in values:
+        if not isinstance(value, BindParameter):
+            return None
+        if params and value.key in params:
+            value = params[value.key]
+        else:
+            value = value.effective_value
+        try:
+            shards.add(shard_for_id(value))
+        except (TypeError, ValueError):
+            return None
+    return shards
+
+
+def _route_criterion(clause, params):
+    if isinstance(clause, Grouping):
+        return _route_criterion(clause.element, params)
+    if isinstance(clause, BinaryExpression):
+        return _route_comparison(clause, params)
+    if isinstance(clause, BooleanClauseList):
+        routes = [_route_criterion(c, params) for c in clause.clauses]
+        if clause.operator is operators.and_:
+            routes = [r for r in routes if r is not None]
+            return set.intersection(*routes) if routes else None
+        if clause.operator is operators.or_ and None not in routes:
+            return set.union(*routes)
+    return None
+
+
+def route(statement, params=None):
+    """Return the set of shards that hold the rows a statement reads or
+    writes, according to the ids it compares against, or None when the
+    rows can be in any shard."""
+    if isinstance(statement, Alias):
+        return route(statement.element, params)
+    if isinstance(statement, CompoundSelect):
+        routes = [route(s, params) for s in statement.selects]
+        return None if None in routes else set.union(*routes)
+    if isinstance(statement, Insert):
+        if statement.select is None:
+            return None
+        return route(statement.select, params)
+    shards = None
+    whereclause = getattr(statement, '_whereclause', None)
+    if whereclause is not None:
+        shards = _route_criterion(whereclause, params)
+    if shards is None and isinstance(statement, Select):
+        # rows selected from subqueries are in the shards of the subqueries
+        routes = [r for r in (route(f, params) for f in statement.froms)
+                  if r is not None]
+        if routes:
+            shards = set.intersection(*routes)
+    return shards
+
+
+class ShardedQuery(BaseQuery):
+    """Query that runs in the shards that hold the rows it selects. Queries
+    that cannot be routed to specific shards run in all of them, and their
+    results are joined in the order of the shards, which is also the order
+    of their ids. For that reason such queries can only be ordered by id,
+    and their limits and offsets are applied across the shards."""
+    _shard_id = None
+
+    def set_shard(self, shard_id):
+        """Return a copy of the query that only runs in the given shard."""
+        q = self._clone()
+        q._shard_id = shard_id
+        return q
+
+    def shards(self, statement=None):
+        """Return the list of shards the query runs in, or None for queries
+        that do not involve sharded tables."""
+        if self._shard_id is not None:
+            return [self._shard_id]
+        shard_count = self.session.shard_count
+        if shard_count == 1:
+            return None
+        if statement is None:
+            statement = self.statement
+        if not _is_sharded(find_tables(statement, include_crud=True)):
+            return None
+        shards = route(statement, self._params)
+        if shards is None:
+            return list(range(shard_count))
+        # ids outside the range of every shard do not match any rows
+        return sorted(s for s in shards if s < shard_count)
+
+    def _execute_and_instances(self, context):
+        shards = self.shards(context.statement)
+        if shards is None:
+            return super(ShardedQuery, self)._execute_and_instances(context)
+        if len(shards) > 1:
+            if self._order_by and not _is_id_column(self._order_by[0]):
+                raise exc.InvalidRequestError(
+                    'Queries that span several shards can only be ordered '
+                    'by id: {0}'.format(context.statement))
+            if self._limit is not None or self._offset:
+                return iter(self._slice(shards, self._offset, self._limit))
+        rows = []
+        for shard_id in shards:
+            conn = self._connection_from_session(
+                mapper=self._mapper_zero_or_none(),
+                clause=context.statement, shard_id=shard_id,
+                close_with_result=True)
+            result = conn.execute(context.statement, self._params)
+            if len(shards) == 1:
+                return loading.instances(self, result, context)
+            rows.extend(loading.instances(self, result, context))
+        return iter(rows)
+
+    def _slice(self, shards, offset, limit, counts=None):
+        """Return the rows from offset to offset + limit, in the order of
+        the shards. The shards before the offset are skipped using their
+        row counts, which are queried if not given, and the shards after
+        the limit is reached are not queried at all."""
+        q = self.limit(None).offset(None)
+        offset = offset or 0
+        rows = []
+        for i, shard_id in enumerate(shards):
+            if limit is not None and len(rows) >= limit:
+                break
+            shard_q = q.set_shard(shard_id)
+            if offset:
+                if counts is None:
+                    count = shard_q.order_by(None).count()
+                else:
+                    count = counts[i]
+                if count <= offset:
+                    offset -= count
+                    continue
+                shard_q = shard_q.offset(offset)
+                offset = 0
+            if limit is not None:
+                shard_q = shard_q.limit(limit - len(rows))
+            rows.extend(shard_q.all())
+        return rows
+
+    def count(self):
+        shards = self.shards()
+        if shards is None or len(shards) == 1:
+            return super(ShardedQuery, self).count()
+        return sum(self.set_shard(s).count() for s in shards)
+
+    def _id_column(self):
+        """Return the id column that orders the results of the query: the
+        primary key for model instances, and the first column for rows,
+        which must be an id."""
+        expr = self.column_descriptions[0]['expr']
+        if isinstance(expr, type) and len(self.column_descriptions) == 1:
+            return class_mapper(expr).primary_key[0]
+        col = getattr(expr, '__clause_element__', lambda: expr)()
+        if not _is_id_column(col):
+            raise exc.InvalidRequestError(
+                'Queries that span several shards can only be paginated '
+                'when their first column is an id: {0}'.format(expr))
+        return col
+
+    def paginate(self, page, per_page=20, error_out=True):
+        shards = self.shards()
+        if shards is None or len(shards) == 1:
+            return super(ShardedQuery, self).paginate(page, per_page,
+                                                      error_out)
+        if error_out and page < 1:
+            abort(404)
+
+        # the counts of the shards are needed for the total anyway, and
+        # they also tell which shards hold the rows of the page
+        q = self.order_by(None)
+        counts = [q.set_shard(shard_id).count() for shard_id in shards]
+        items = q.order_by(self._id_column())._slice(
+            shards, (page - 1) * per_page, per_page, counts)
+        if not items and page != 1 and error_out:
+            abort(404)
+        return Pagination(self, page, per_page, sum(counts), items)
+
+
+class ShardedSession(_SignallingSession):
+    """Session that sends the statements on sharded tables to the shards
+    that hold their rows. Rows that are not in the database yet go to the
+    shard of their sharded parent, while rows without one, such as new
+    customers, are assigned to the shards in turn."""
+    def __init__(self, db, **options):
+        options.setdefault('query_cls', ShardedQuery)
+        config = db.get_app().config
+        if config['SQLALCHEMY_SHARDS']:
+            # the changes and their entries in the change log can be in
+            # different databases, which have to commit together
+            options.setdefault('twophase',
+                               config['SQLALCHEMY_SHARDS_TWOPHASE'])
+        super(ShardedSession, self).__init__(db, **options)
+        self.db = db
+        self.shard_count = len(self.app.config['SQLALCHEMY_SHARDS']) + 1
+        self.shard_ids = list(range(self.shard_count))
+        if self.shard_count > 1:
+            # the unit of work asks for a connection for each row it writes
+            self.connection_callable = self._connection_for_instance
+
+    def _connection_for_instance(self, mapper, instance):
+        return self.connection(mapper, instance=instance)
+
+    def shard_for_instance(self, instance):
+        """Return the shard of a row of a sharded table."""
+        state = instance_state(instance)
+        if state.key is not None:
+            return shard_for_id(state.key[1][0])
+        shard_id = getattr(instance, '_shard_id', None)
+        if shard_id is None:
+            for rel in state.mapper.relationships:
+                if rel.direction is MANYTOONE and \
+                        rel.mapper.mapped_table.info.get('sharded'):
+                    parent = getattr(instance, rel.key)
+                    if parent is not None:
+                        shard_id = self.shard_for_instance(parent)
+                        break
+            else:
+                shard_id = next(self.db.shard_counter) % self.shard_count
+            instance._shard_id = shard_id
+        return shard_id
+
+    def get_bind(self, mapper=None, clause=None, shard_id=None,
+                 instance=None, **kw):
+        if self.shard_count > 1:
+            if mapper is not None:
+                tables = [mapper.mapped_table]
+            elif clause is not None:
+                tables = find_tables(clause, include_crud=True)
+            else:
+                tables = []
+            if _is_sharded(tables):
+                if shard_id is None and instance is not None \
+                        and mapper is not None:
+                    shard_id = self.shard_for_instance(instance)
+                elif shard_id is None:
+                    shards = route(clause) if clause is not None else None
+                    if shards is None or len(shards) != 1:
+                        raise exc.InvalidRequestError(
+                            'Cannot determine the shard of: {0}'.format(
+                                clause))
+                    shard_id = shards.pop()
+            elif not any(t.info.get('replicated') for t in tables):
+                # tables that are not sharded or replicated only exist in
+                # the main database
+                shard_id = None
+            if shard_id:
+                if shard_id >= self.shard_count:
+                    raise exc.InvalidRequestError(
+                        'Invalid shard: {0}'.format(shard_id))
+                return self.db.get_engine(self.app, shard_bind(shard_id))
+        return super(ShardedSession, self).get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension that shards customers, along with their
+    orders and items, across several databases.
+
+    The additional databases are given as a list of URIs in the
+    SQLALCHEMY_SHARDS configuration setting, and the application's main
+    database is the first shard. Tables marked as sharded in their info
+    dictionary exist in all the shards, and each row is stored in one of
+    them. Tables marked as replicated are read from the main database, and
+    their changes are copied to all the shards, so that the foreign keys
+    that point to them can be checked in every shard. All other tables only
+    exist in the main database. Writes that span several databases are
+    committed with two-phase commits, so sharding needs PostgreSQL or MySQL
+    databases, except in tests, which can use SQLite. Without shards
+    configured, this extension works exactly like the plain one."""
+    def __init__(self, *args, **kwargs):
+        self.shard_counter = itertools.count()
+        super(ShardedSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        # the shards are registered as binds, so that the extension manages
+        # their engines
+        app.config.setdefault('SQLALCHEMY_SHARDS', [])
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for shard_id, uri in enumerate(app.config['SQLALCHEMY_SHARDS'], 1):
+            binds[shard_bind(shard_id)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+        if app.config['SQLALCHEMY_SHARDS']:
+            uris = [app.config['SQLALCHEMY_DATABASE_URI']] + \
+                app.config['SQLALCHEMY_SHARDS']
+            dialects = set(make_url(uri).drivername.split('+')[0]
+                           for uri in uris)
+            unsupported = dialects - set(_dialects)
+            if unsupported:
+                raise RuntimeError('Cannot shard databases of type: ' +
+                                   ', '.join(sorted(unsupported)))
+            twophase = all(_dialects[d] for d in dialects)
+            app.config.setdefault('SQLALCHEMY_SHARDS_TWOPHASE', twophase)
+            if not twophase and not app.config.get('TESTING'):
+                raise RuntimeError('Sharding requires databases with '
+                                   'two-phase commits outside of tests, so '
+                                   'that changes are logged atomically')
+        super(ShardedSQLAlchemy, self).init_app(app)
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(ShardedSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(ShardedSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and \
+                info.database in (None, '', ':memory:'):
+            # an in-memory database lives as long as its connection, so all
+            # the threads share a single one
+            options.setdefault('poolclass', StaticPool)
+            options.setdefault('connect_args', {'check_same_thread': False})
+
+    def make_declarative_base(self):
+        base = super(ShardedSQLAlchemy, self).make_declarative_base()
+        base.query_class = ShardedQuery
+        return base
+
+    def _execute_for_all_tables(self, app, bind, operation):
+        super(ShardedSQLAlchemy, self)._execute_for_all_tables(app, bind,
+                                                               operation)
+        if bind != '__all__':
+            return
+        app = self.get_app(app)
+        tables = [t for t in self.Model.metadata.sorted_tables
+                  if t.info.get('sharded') or t.info.get('replicated')]
+        for shard_id in range(1, len(app.config['SQLALCHEMY_SHARDS']) + 1):
+            engine = self.get_engine(app, shard_bind(shard_id))
+            getattr(self.Model.metadata, operation)(bind=engine,
+                                                    tables=tables)
+            if operation == 'create_all':
+                _start_ids(engine, tables, shard_id)
+
+
+def _start_ids(engine, tables, shard_id):
+    """Start the ids generated by the sharded tables of a shard at the
+    beginning of the shard's range. Sequences that are already in the range
+    are left alone."""
+    start = (shard_id << SHARD_BITS) + 1
+    sequences = table('sqlite_sequence', column('name'), column('seq'))
+    with engine.begin() as conn:
+        for t in tables:
+            if not t.info.get('sharded') or \
+                    not t.kwargs.get('sqlite_autoincrement'):
+                continue
+            pk = t.primary_key.columns.values()[0]
+            if engine.dialect.name == 'sqlite':
+                # the AUTOINCREMENT sequence has the last id used
+                if conn.execute(select([sequences.c.seq]).where(
+                        sequences.c.name == t.name)).first() is None:
+                    conn.execute(sequences.insert().values(
+                        name=t.name, seq=start - 1))
+                continue
+            if (conn.execute(select([func.max(pk)])).scalar() or 0) >= start:
+                continue
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text(
+                    'SELECT setval(pg_get_serial_sequence(:table, :column), '
+                    ':start, false)'), table=t.name, column=pk.name,
+                    start=start)
+            elif engine.dialect.name == 'mysql':
+                conn.execute('ALTER TABLE {0} AUTO_INCREMENT = {1}'.format(
+                    engine.dialect.identifier_preparer.quote(t.name), start))
+
+
+@event.listens_for(Session, 'after_flush')
+def replicate_changes(session, flush_context):
+    """Copy the changes a flush made to replicated tables to all the
+    shards, in the same transaction."""
+    if getattr(session, 'shard_count', 1) == 1:
+        return
+    statements = []
+    for obj in session.new:
+        t = obj.__table__
+        if t.info.get('replicated'):
+            statements.append(t.insert().values(
+                {c.key: getattr(obj, c.key) for c in t.columns}))
+    for obj in session.dirty:
+        t = obj.__table__
+        if t.info.get('replicated') and session.is_modified(
+                obj, include_collections=False):
+            statements.append(t.update().where(t.c.id == obj.id).values(
+                {c.key: getattr(obj, c.key) for c in t.columns}))
+    for obj in session.deleted:
+        t = obj.__table__
+        if t.info.get('replicated'):
+            statements.append(t.delete().where(t.c.id == obj.id))
+    for shard_id in session.shard_ids[1:]:
+        for statement in statements:
+            session.execute(statement, shard_id=shard_id)
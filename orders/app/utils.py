@@ -1,7 +1,8 @@
+from flask import request
 from flask.globals import _app_ctx_stack, _request_ctx_stack
 from werkzeug.urls import url_parse
 from werkzeug.exceptions import NotFound
-from .exceptions import ValidationError
+from .exceptions import ValidationError, PreconditionFailed
 
 
 def split_url(url, method='GET'):
@@ -31,4 +32,32 @@ def split_url(url, method='GET'):
         result = url_adapter.match(parsed_url.path, method)
     except NotFound:
         raise ValidationError('Invalid URL: ' + url)
-    return result
\ No newline at end of file
+    return result
+
+
+def version_from_etag(etag):
+    """Return the resource version encoded in an entity tag, or None if the
+    tag was not generated from a version."""
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    try:
+        return int(etag.strip('"').split('-')[0])
+    except ValueError:
+        return None
+
+
+def check_if_match(resource):
+    """Raise PreconditionFailed if the request has an If-Match header that
+    does not match the version of the given resource. The version is checked
+    again by the database when the changes are committed, so that concurrent
+    updates are also detected."""
+    if_match = request.headers.get('If-Match')
+    if not if_match:
+        return
+    etag_list = [tag.strip() for tag in if_match.split(',')]
+    if '*' in etag_list:
+        return
+    if resource.version not in [version_from_etag(tag)
+                                for tag in etag_list]:
+        raise PreconditionFailed('Resource has been modified')
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""Move old orders and their items to the archive tables.
+
+The age and batch size are taken from the ARCHIVE_MAX_AGE (in days) and
+ARCHIVE_BATCH_SIZE configuration settings, and can be given in the command
+line. The archived orders remain available through the API."""
+import argparse
+import os
+from app import create_app, db
+from app.archive import archive_orders
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-age', type=int,
+                        help='archive orders older than this many days')
+    parser.add_argument('--batch-size', type=int,
+                        help='number of orders moved in each transaction')
+    args = parser.parse_args()
+
+    app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+    with app.app_context():
+        db.create_all()
+        count = archive_orders(
+            args.max_age or app.config.get('ARCHIVE_MAX_AGE', 90),
+            args.batch_size or app.config.get('ARCHIVE_BATCH_SIZE', 500))
+        print('{0} orders archived'.format(count))
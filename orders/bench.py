@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""Load and latency benchmark for the orders API.
+
+Seed a benchmark database, then run a request mix against it:
+
+    python bench.py seed --customers 1000 --products 500 --orders 100000 \\
+        --items 500000
+    python bench.py run --mix read --requests 20000 --workers 4 \\
+        --output results.json
+    python bench.py compare before.json after.json
+    python bench.py serialize --rows 25 1000
+
+Requests are sent through the WSGI interface of the application, so the
+numbers include routing, authentication, rate limiting, the decorators and
+the database, but not a web server or the network."""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+from base64 import b64encode
+from datetime import datetime, timedelta
+from time import perf_counter
+
+BATCH_SIZE = 10000
+
+# request mixes, given as relative weights for each type of request
+MIXES = {
+    'read': {'get_orders': 10, 'get_orders_expanded': 5, 'get_order': 30,
+             'get_customer': 15, 'get_customer_orders': 10,
+             'get_order_items': 15, 'get_order_items_expanded': 5,
+             'get_product': 10},
+    'write': {'new_customer_order': 30, 'edit_order': 30,
+              'new_order_item': 30, 'edit_item': 10},
+    'mixed': {'get_orders': 10, 'get_order': 25, 'get_customer': 10,
+              'get_customer_orders': 10, 'get_order_items': 15,
+              'get_product': 10, 'new_customer_order': 5, 'edit_order': 5,
+              'new_order_item': 5, 'edit_item': 5},
+}
+
+
+def build_request(name, rnd, sizes):
+    """Return the method, URL and JSON body of a request of the given type,
+    with random resource ids chosen within the seeded data."""
+    customer = rnd.randint(1, sizes['customers'])
+    product = rnd.randint(1, sizes['products'])
+    order = rnd.randint(1, sizes['orders'])
+    item = rnd.randint(1, sizes['items'])
+    date = datetime(2014, 1, 1) + timedelta(seconds=rnd.randint(0, 30000000))
+    requests = {
+        'get_orders': ('GET', '/api/v1/orders/?page={0}'.format(
+            rnd.randint(1, max(sizes['orders'] // 25, 1))), None),
+        'get_orders_expanded': ('GET', '/api/v1/orders/?expanded=1', None),
+        'get_order': ('GET', '/api/v1/orders/{0}'.format(order), None),
+        'get_customer': ('GET', '/api/v1/customers/{0}'.format(customer),
+                         None),
+        'get_customer_orders': (
+            'GET', '/api/v1/customers/{0}/orders/'.format(customer), None),
+        'get_order_items': (
+            'GET', '/api/v1/orders/{0}/items/'.format(order), None),
+        'get_order_items_expanded': (
+            'GET', '/api/v1/orders/{0}/items/?expanded=1'.format(order),
+            None),
+        'get_product': ('GET', '/api/v1/products/{0}'.format(product), None),
+        'new_customer_order': (
+            'POST', '/api/v1/customers/{0}/orders/'.format(customer),
+            {'date': date.isoformat() + 'Z'}),
+        'edit_order': ('PUT', '/api/v1/orders/{0}'.format(order),
+                       {'date': date.isoformat() + 'Z'}),
+        'new_order_item': (
+            'POST', '/api/v1/orders/{0}/items/'.format(order),
+            {'product_url': '/api/v1/products/{0}'.format(product),
+             'quantity': rnd.randint(1, 10)}),
+        'edit_item': ('PUT', '/api/v1/items/{0}'.format(item),
+                      {'product_url': '/api/v1/products/{0}'.format(product),
+                       'quantity': rnd.randint(1, 10)}),
+    }
+    return requests[name]
+
+
+def seed(args):
+    """Create a fresh benchmark database with random data."""
+    from app import create_app, db
+    from app.models import User, Customer, Product, Order, Item
+
+    if not args.config.startswith('benchmark') and not args.force:
+        # seeding drops all the tables of the database
+        sys.exit('Refusing to seed the {0} database, use --force to seed '
+                 'it anyway.'.format(args.config))
+    app = create_app(args.config)
+    rnd = random.Random(args.seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        u = User(username='john')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+
+        def insert(model, count, row):
+            # bulk inserts through the core, in batches to keep the memory
+            # usage flat regardless of the number of rows
+            for start in range(1, count + 1, BATCH_SIZE):
+                db.session.execute(
+                    model.__table__.insert(),
+                    [row(i) for i in range(start,
+                                           min(start + BATCH_SIZE,
+                                               count + 1))])
+                db.session.commit()
+            print('{0}: {1} rows'.format(model.__tablename__, count))
+
+        start_date = datetime(2014, 1, 1)
+        insert(Customer, args.customers,
+               lambda i: {'id': i, 'name': 'customer {0}'.format(i),
+                          'version': 1})
+        insert(Product, args.products,
+               lambda i: {'id': i, 'name': 'product {0}'.format(i),
+                          'version': 1})
+        insert(Order, args.orders,
+               lambda i: {'id': i,
+                          'customer_id': rnd.randint(1, args.customers),
+                          'date': start_date + timedelta(
+                              seconds=rnd.randint(0, 30000000)),
+                          'version': 1})
+        insert(Item, args.items,
+               lambda i: {'id': i, 'order_id': rnd.randint(1, args.orders),
+                          'product_id': rnd.randint(1, args.products),
+                          'quantity': rnd.randint(1, 10), 'version': 1})
+
+
+def run_worker(worker, args, count):
+    """Send count requests from the selected mix and return the latencies
+    observed for each request type, along with the number of errors."""
+    from app import create_app, db
+    from app.models import User, Customer, Product, Order, Item
+
+    app = create_app(args.config)
+    client = app.test_client()
+    rnd = random.Random('{0}-{1}'.format(args.seed, worker))
+    mix = sorted(MIXES[args.mix].items())
+    names = [name for name, weight in mix]
+    weights = [weight for name, weight in mix]
+    with app.app_context():
+        sizes = {'customers': Customer.query.count(),
+                 'products': Product.query.count(),
+                 'orders': Order.query.count(),
+                 'items': Item.query.count()}
+        token = User.query.filter_by(username='john').first() \
+            .generate_auth_token(expires_in=24 * 3600)
+        db.session.remove()
+    headers = {'Authorization': 'Basic ' + b64encode(
+        (token + ':').encode('utf-8')).decode('utf-8')}
+
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    for i in range(args.warmup + count):
+        name = rnd.choices(names, weights)[0]
+        method, url, data = build_request(name, rnd, sizes)
+        start = perf_counter()
+        rv = client.open(url, method=method, headers=headers,
+                         data=json.dumps(data) if data else None,
+                         content_type='application/json')
+        rv.get_data()
+        elapsed = perf_counter() - start
+        if i < args.warmup:
+            continue
+        latencies[name].append(elapsed)
+        if rv.status_code >= 400:
+            errors[name] += 1
+    return latencies, errors
+
+
+def _run_worker(params):
+    return run_worker(*params)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list, by nearest rank."""
+    if not values:
+        return None
+    return values[max(int(round(p / 100.0 * len(values))) - 1, 0)]
+
+
+def summarize(latencies, errors, elapsed):
+    """Compute throughput and latency percentiles for a list of latencies
+    and an error count."""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def run(args):
+    """Run a request mix and report the results per request type."""
+    counts = [args.requests // args.workers + (i < args.requests %
+                                                args.workers)
+              for i in range(args.workers)]
+    start = perf_counter()
+    if args.workers == 1:
+        results = [run_worker(0, args, counts[0])]
+    else:
+        pool = multiprocessing.Pool(args.workers)
+        try:
+            results = pool.map(_run_worker,
+                               [(i, args, counts[i])
+                                for i in range(args.workers)])
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = perf_counter() - start
+
+    # merge the results of all the workers
+    latencies = {}
+    errors = {}
+    for worker_latencies, worker_errors in results:
+        for name, values in worker_latencies.items():
+            latencies.setdefault(name, []).extend(values)
+            errors[name] = errors.get(name, 0) + worker_errors[name]
+
+    report = {
+        'date': datetime.utcnow().isoformat() + 'Z',
+        'config': args.config,
+        'mix': args.mix,
+        'workers': args.workers,
+        'seed': args.seed,
+        'elapsed': elapsed,
+        'total': summarize(sum(latencies.values(), []),
+                           sum(errors.values()), elapsed),
+        'endpoints': {name: summarize(latencies[name], errors[name],
+                                      elapsed)
+                      for name in sorted(latencies)},
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def _ms(value):
+    return '-' if value is None else '{0:.2f}'.format(value * 1000)
+
+
+def print_report(report):
+    print('{0:<26} {1:>8} {2:>6} {3:>9} {4:>8} {5:>8} {6:>8}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    rows = sorted(report['endpoints'].items()) + [('total',
+                                                   report['total'])]
+    for name, r in rows:
+        print('{0:<26} {1:>8} {2:>6} {3:>9.1f} {4:>8} {5:>8} {6:>8}'.format(
+            name, r['requests'], r['errors'], r['throughput'] or 0,
+            _ms(r['p50']), _ms(r['p95']), _ms(r['p99'])))
+
+
+def compare(args):
+    """Print the change in throughput and latency between two runs."""
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print('{0:<26} {1:>9} {2:>9} {3:>9} {4:>9}'.format(
+        'endpoint', 'req/s', 'p50', 'p95', 'p99'))
+    names = sorted(set(before['endpoints']) & set(after['endpoints']))
+    rows = [(name, before['endpoints'][name], after['endpoints'][name])
+            for name in names] + [('total', before['total'],
+                                   after['total'])]
+    for name, b, a in rows:
+        changes = []
+        for key in ('throughput', 'p50', 'p95', 'p99'):
+            if b[key] and a[key] is not None:
+                changes.append('{0:+.1f}%'.format(
+                    (a[key] - b[key]) * 100.0 / b[key]))
+            else:
+                changes.append('-')
+        print('{0:<26} {1:>9} {2:>9} {3:>9} {4:>9}'.format(name, *changes))
+
+
+def serialize(args):
+    """Compare the time it takes to render a page of orders from model
+    instances with export_data() and jsonify(), against the serializer path
+    with each of the available JSON encoders."""
+    from flask import jsonify
+    from app import create_app, db
+    from app.models import Order
+    from app.representations import _json_encoders
+    from app.serializers import get_serializer
+
+    def export_data(n):
+        orders = Order.query.limit(n).all()
+        return jsonify({'orders': [o.export_data() for o in orders]}) \
+            .get_data()
+
+    def serializer(encode):
+        def run(n):
+            s = get_serializer(Order)
+            data = {'orders': s.dump(s.query(Order.query).limit(n).all())}
+            return jsonify(data).get_data() if encode is None \
+                else encode(data)
+        return run
+
+    paths = [('export_data+jsonify', export_data),
+             ('serializer+jsonify', serializer(None))]
+    paths += [('serializer+' + name, serializer(encode))
+              for name, encode in sorted(_json_encoders.items())]
+    app = create_app(args.config)
+    report = {'date': datetime.utcnow().isoformat() + 'Z',
+              'config': args.config, 'repeat': args.repeat, 'results': {}}
+    print('{0:<24} {1:>6} {2:>10} {3:>10}'.format('path', 'rows', 'p50 ms',
+                                                 'rows/s'))
+    with app.test_request_context('/api/v1/orders/'):
+        for n in args.rows:
+            for name, path in paths:
+                times = []
+                for i in range(args.repeat):
+                    # start each run with an empty session, so that nothing
+                    # is reused from the identity map
+                    db.session.remove()
+                    start = perf_counter()
+                    path(n)
+                    times.append(perf_counter() - start)
+                times.sort()
+                p50 = percentile(times, 50)
+                report['results'].setdefault(str(n), {})[name] = {
+                    'p50': p50, 'p95': percentile(times, 95),
+                    'rows_per_second': n / p50}
+                print('{0:<24} {1:>6} {2:>10} {3:>10.0f}'.format(
+                    name, n, _ms(p50), n / p50))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='benchmark')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the data and the requests')
+    commands = parser.add_subparsers(dest='command')
+
+    seed_parser = commands.add_parser('seed', help='seed the database')
+    seed_parser.add_argument('--customers', type=int, default=100)
+    seed_parser.add_argument('--products', type=int, default=100)
+    seed_parser.add_argument('--orders', type=int, default=1000)
+    seed_parser.add_argument('--items', type=int, default=5000)
+    seed_parser.add_argument('--force', action='store_true',
+                             help='seed a database that is not a benchmark '
+                             'one, deleting all its data')
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser('run', help='run a request mix')
+    run_parser.add_argument('--mix', choices=sorted(MIXES), default='read')
+    run_parser.add_argument('--requests', type=int, default=5000)
+    run_parser.add_argument('--warmup', type=int, default=100,
+                            help='requests per worker not measured')
+    run_parser.add_argument('--workers', type=int, default=1,
+                            help='number of worker processes')
+    run_parser.add_argument('--output', help='save the results as JSON')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare',
+                                         help='compare two saved runs')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(func=compare)
+
+    serialize_parser = commands.add_parser(
+        'serialize', help='compare the serialization paths')
+    serialize_parser.add_argument('--rows', type=int, nargs='+',
+                                  default=[25, 1000])
+    serialize_parser.add_argument('--repeat', type=int, default=20)
+    serialize_parser.add_argument('--output', help='save the results as JSON')
+    serialize_parser.set_defaults(func=serialize)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        return 1
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+db_path = os.path.join(basedir, '../data-bench.sqlite')
+
+DEBUG = False
+SECRET_KEY = 'top-secret!'
+SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+                          'sqlite:///' + db_path
+# all the requests of a benchmark are sent by one user from one address, so
+# the rate limiter runs with limits that are never reached
+RATE_LIMITS = {'api': (10 ** 9, 1), 'api:ip': (10 ** 9, 1)}
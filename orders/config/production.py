@@ -7,3 +7,7 @@ DEBUG = False
 SECRET_KEY = 'top-secret!'
 SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                           'sqlite:///' + db_path
+# additional databases that customers, orders and items are sharded across,
+# which must be PostgreSQL or MySQL databases, as writes that span several
+# of them are committed with two-phase commits
+SQLALCHEMY_SHARDS = os.environ.get('DATABASE_SHARD_URLS', '').split()
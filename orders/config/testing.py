@@ -1,10 +1,8 @@
-import os
-
-basedir = os.path.abspath(os.path.dirname(__file__))
-db_path = os.path.join(basedir, '../data-test.sqlite')
-
 DEBUG = False
 TESTING = True
 SECRET_KEY = 'top-secret!'
 SERVER_NAME = 'example.com'
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
+# each test process gets its own in-memory database
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+# password hashes do not need to be expensive to compute in tests
+PASSWORD_HASH_METHOD = 'pbkdf2:sha1:1'
@@ -0,0 +1,7 @@
+DEBUG = False
+TESTING = True
+SECRET_KEY = 'top-secret!'
+SERVER_NAME = 'example.com'
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+SQLALCHEMY_SHARDS = ['sqlite://', 'sqlite://']
+PASSWORD_HASH_METHOD = 'pbkdf2:sha1:1'
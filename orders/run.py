@@ -3,6 +3,36 @@ import os
 from app import create_app, db
 from app.models import User
 
+# routes that stream responses for a long time, and run as greenlets in the
+# asynchronous mode
+streaming_routes = ['api.get_order_events']
+
+
+def serve_async(app, host='127.0.0.1', port=5000):
+    """Run the application on a gevent server. Streaming routes run as
+    greenlets, so each idle event stream costs a greenlet instead of a
+    thread. All other routes run in a pool of ASYNC_THREADS threads."""
+    import gevent
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+    from werkzeug.exceptions import HTTPException
+    from app.events import hub
+
+    hub.sleep = gevent.sleep
+    pool = ThreadPool(app.config.get('ASYNC_THREADS', 4))
+
+    def application(environ, start_response):
+        try:
+            endpoint, args = app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint = None
+        if endpoint in streaming_routes:
+            return app(environ, start_response)
+        return pool.apply(app, (environ, start_response))
+
+    WSGIServer((host, port), application).serve_forever()
+
+
 if __name__ == '__main__':
     app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
     with app.app_context():
@@ -13,4 +43,9 @@ if __name__ == '__main__':
             u.set_password('cat')
             db.session.add(u)
             db.session.commit()
-    app.run()
+    if os.environ.get('ORDERS_ASYNC'):
+        serve_async(app)
+    else:
+        # event streams hold on to their thread, so other requests need
+        # threads of their own
+        app.run(threaded=True)
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from functools import partial
+from sqlalchemy import event, orm
+from app.shards import ShardedSession
+
+
+class RolledBackSession(ShardedSession):
+    """Session that works inside a savepoint, so that its commits and
+    rollbacks behave as usual within the transaction of a rolled_back()
+    block."""
+    def __init__(self, db, **options):
+        super(RolledBackSession, self).__init__(db, **options)
+        self.begin_nested()
+
+
+@event.listens_for(RolledBackSession, 'after_transaction_end')
+def restart_savepoint(session, transaction):
+    """Start a new savepoint when the session commits or rolls back the
+    previous one."""
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+@contextmanager
+def rolled_back(db, app):
+    """Run a block in a transaction that is rolled back at the end, in all
+    the databases of the application. Each database is used through a single
+    connection that has the transaction open, and the sessions work inside
+    savepoints, so all the changes are undone when the block ends. This lets
+    the tests share a database without recreating it for each test."""
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+    connections = {}
+    transactions = []
+    isolation_levels = {}
+    session = db.session
+    try:
+        for bind in binds:
+            conn = db.get_engine(app, bind).connect()
+            connections[bind] = conn
+            transactions.append(conn.begin())
+            if conn.dialect.name == 'sqlite':
+                # pysqlite only supports savepoints when transactions are
+                # started explicitly
+                isolation_levels[bind] = conn.connection.isolation_level
+                conn.connection.isolation_level = None
+                conn.execute('BEGIN')
+        # the connections stand in for the engines, for the sessions as
+        # well as for the code that uses the engines directly
+        db.get_engine = lambda app=None, bind=None: connections[bind]
+        db.session = orm.scoped_session(partial(RolledBackSession, db))
+        yield
+    finally:
+        if db.session is not session:
+            db.session.remove()
+        db.session = session
+        db.__dict__.pop('get_engine', None)
+        for transaction in transactions:
+            transaction.rollback()
+        for bind, conn in connections.items():
+            if bind in isolation_levels:
+                conn.connection.isolation_level = isolation_levels[bind]
+            conn.close()
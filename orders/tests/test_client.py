@@ -1,6 +1,9 @@
 from base64 import b64encode
 import json
+import zlib
 from urllib.parse import urlsplit, urlunsplit
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 
 class TestClient():
@@ -8,6 +11,7 @@ class TestClient():
         self.app = app
         self.auth = 'Basic ' + b64encode((username + ':' + password)
                                          .encode('utf-8')).decode('utf-8')
+        self.queries = []  # SQL statements issued by each request
 
     def send(self, url, method='GET', data=None, headers={}):
         # for testing, URLs just need to have the path and query string
@@ -25,15 +29,35 @@ class TestClient():
         if data:
             data = json.dumps(data)
 
+        # record the SQL statements issued while the request is handled
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context,
+                             executemany):
+            # savepoints replace the transactions of the sessions in tests,
+            # and are not issued outside of them
+            if 'SAVEPOINT' not in statement:
+                statements.append(statement)
+
         # send request to the test client and return the response
-        with self.app.test_request_context(url, method=method, data=data,
-                                           headers=headers):
-            rv = self.app.preprocess_request()
-            if rv is None:
-                rv = self.app.dispatch_request()
-            rv = self.app.make_response(rv)
-            rv = self.app.process_response(rv)
-            return rv, json.loads(rv.data.decode('utf-8'))
+        event.listen(Engine, 'before_cursor_execute', record_statement)
+        try:
+            with self.app.test_request_context(url, method=method, data=data,
+                                               headers=headers):
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = self.app.dispatch_request()
+                rv = self.app.make_response(rv)
+                rv = self.app.process_response(rv)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record_statement)
+            self.queries.append(statements)
+        data = rv.data
+        if rv.headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif rv.headers.get('Content-Encoding') == 'deflate':
+            data = zlib.decompress(data)
+        return rv, json.loads(data.decode('utf-8'))
 
     def get(self, url, headers={}):
         return self.send(url, 'GET', headers=headers)
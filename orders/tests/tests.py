@@ -1,31 +1,84 @@
+import importlib
+import time
 import unittest
+from datetime import datetime
+import msgpack
+import cbor2
+from contextlib import contextmanager
 from werkzeug.exceptions import NotFound
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm.exc import StaleDataError
 from app import create_app, db
-from app.models import User, Customer
+from app.exceptions import ValidationError, PreconditionFailed
+from app.models import User, Customer, Product, Order, Item, \
+    ArchivedOrder, ArchivedItem
+from app.archive import archive_orders
+from app.models import product_cache
+from app.serializers import get_serializer
+from app.events import hub
+from app.shards import shard_for_id, shard_bind
 from .test_client import TestClient
+from .rollback import rolled_back
 
 
 class TestAPI(unittest.TestCase):
     default_username = 'dave'
     default_password = 'cat'
+    apps = {}  # applications created by this process, by configuration
 
     def setUp(self):
-        self.app = create_app('testing')
+        self.start_app('testing')
+
+    def tearDown(self):
+        self.stop_app()
+
+    def start_app(self, config_name):
+        """Push the context of an application with a client that is
+        authenticated as the default user. The application and its
+        in-memory databases are created once per process, and each test
+        runs in a transaction that is rolled back when it ends."""
+        if config_name not in self.apps:
+            app = create_app(config_name)
+            with app.app_context():
+                db.create_all()
+                u = User(username=self.default_username)
+                u.set_password(self.default_password)
+                db.session.add(u)
+                db.session.commit()
+                token = u.generate_auth_token(expires_in=86400)
+                db.session.remove()
+            self.apps[config_name] = (app, token)
+        self.app, token = self.apps[config_name]
+        self.config = self.app.config.copy()
         self.ctx = self.app.app_context()
         self.ctx.push()
-        db.drop_all()
-        db.create_all()
-        u = User(username=self.default_username)
-        u.set_password(self.default_password)
-        db.session.add(u)
-        db.session.commit()
-        self.client = TestClient(self.app, u.generate_auth_token(), '')
+        self.transaction = rolled_back(db, self.app)
+        self.transaction.__enter__()
+        # rows cached from a previous test may have been rolled back, and
+        # the rate limits start over
+        product_cache.invalidate()
+        importlib.import_module('app.decorators.rate_limit')._limiter = None
+        self.client = TestClient(self.app, token, '')
 
-    def tearDown(self):
+    def stop_app(self):
         db.session.remove()
-        db.drop_all()
+        self.transaction.__exit__(None, None, None)
+        self.app.config.clear()
+        self.app.config.update(self.config)
         self.ctx.pop()
 
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """Fail if any request sent in the block issues more than n SQL
+        statements."""
+        first = len(self.client.queries)
+        yield
+        for statements in self.client.queries[first:]:
+            self.assertTrue(len(statements) <= n,
+                            'Expected at most {0} queries, got {1}:\n{2}'
+                            .format(n, len(statements),
+                                    '\n'.join(statements)))
+
     def test_customers(self):
         # get list of customers
         rv, json = self.client.get('/api/v1/customers/')
@@ -226,3 +279,783 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(len(json['customers']) == 25)
         self.assertTrue(json['customers'][0]['name'] == customers[0].name)
         self.assertTrue(json['customers'][24]['name'] == customers[24].name)
+
+    def test_compression(self):
+        customers = [Customer(name='customer_{0:02d}'.format(i))
+                     for i in range(0, 25)]
+        db.session.add_all(customers)
+        db.session.commit()
+
+        # without Accept-Encoding responses are not compressed
+        rv, json = self.client.get('/api/v1/customers/?expanded=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertIn('Accept-Encoding', rv.vary)
+        plain_etag = rv.headers['ETag']
+        plain_length = len(rv.data)
+
+        # large responses are compressed with the preferred encoding
+        rv, json = self.client.get('/api/v1/customers/?expanded=1',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue(len(rv.data) < plain_length)
+        self.assertTrue(len(json['customers']) == 25)
+        self.assertTrue(json['customers'][0]['name'] == 'customer_00')
+        gzip_etag = rv.headers['ETag']
+        self.assertTrue(gzip_etag != plain_etag)
+
+        # each encoding has its own etag
+        rv, json = self.client.get('/api/v1/customers/?expanded=1',
+                                   headers={'Accept-Encoding': 'gzip',
+                                            'If-None-Match': gzip_etag})
+        self.assertTrue(rv.status_code == 304)
+        self.assertTrue(rv.headers['ETag'] == gzip_etag)
+        self.assertIn('Accept-Encoding', rv.vary)
+        rv, json = self.client.get(
+            '/api/v1/customers/?expanded=1',
+            headers={'Accept-Encoding': 'deflate, gzip;q=0.5',
+                     'If-None-Match': gzip_etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['Content-Encoding'] == 'deflate')
+        self.assertTrue(len(json['customers']) == 25)
+
+        # small responses are not compressed
+        rv, json = self.client.get(customers[0].get_url(),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertTrue(json['name'] == 'customer_00')
+
+    def test_representations(self):
+        client = self.app.test_client()
+        headers = {'Authorization': self.client.auth,
+                   'Accept': 'application/msgpack'}
+
+        # add a customer with a MessagePack body
+        rv = client.post('/api/v1/customers/', headers=headers,
+                         data=msgpack.packb({'name': 'john'}),
+                         content_type='application/msgpack')
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(rv.mimetype == 'application/msgpack')
+        location = rv.headers['Location']
+
+        # get the customer back in each of the formats
+        rv = client.get(location, headers=headers)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/msgpack')
+        self.assertIn('Accept', rv.vary)
+        self.assertTrue(msgpack.unpackb(rv.data)['name'] == 'john')
+        headers['Accept'] = 'application/cbor'
+        rv = client.get(location, headers=headers)
+        self.assertTrue(rv.mimetype == 'application/cbor')
+        self.assertTrue(cbor2.loads(rv.data)['name'] == 'john')
+        headers['Accept'] = 'text/html'
+        rv = client.get(location, headers=headers)
+        self.assertTrue(rv.mimetype == 'application/json')
+
+        # edit the customer with a CBOR body
+        rv = client.put(location, headers=headers,
+                        data=cbor2.dumps({'name': 'susan'}),
+                        content_type='application/cbor')
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(location)
+        self.assertTrue(json['name'] == 'susan')
+
+        # errors use the requested format too
+        headers['Accept'] = 'application/msgpack'
+        rv = client.put(location, headers=headers, data=b'\xc1',
+                        content_type='application/msgpack')
+        self.assertTrue(rv.status_code == 400)
+        self.assertTrue(msgpack.unpackb(rv.data)['error'] == 'bad request')
+        rv = client.get('/api/v1/customers/12345', headers=headers)
+        self.assertTrue(rv.status_code == 404)
+        self.assertTrue(msgpack.unpackb(rv.data)['status'] == 404)
+
+        # JSON can be generated with a different encoder
+        self.app.config['JSON_ENCODER'] = 'json'
+        rv, json = self.client.get('/api/v1/customers/?expanded=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.data.startswith(b'{"'))
+        self.assertTrue(json['customers'][0]['name'] == 'susan')
+
+    def test_serializers(self):
+        customer = Customer(name='john')
+        product = Product(name='prod')
+        order = Order(customer=customer)
+        item = Item(order=order, product=product, quantity=3)
+        db.session.add_all([customer, product, order, item])
+        db.session.commit()
+
+        # serializers must give the same results as the models
+        with self.app.test_request_context():
+            for model in [Customer, Product, Order, Item]:
+                serializer = get_serializer(model)
+                rows = serializer.query(model.query).all()
+                self.assertTrue(serializer.dump(rows) ==
+                                [r.export_data() for r in model.query])
+                rows = serializer.url_query(model.query).all()
+                self.assertTrue(serializer.dump_urls(rows) ==
+                                [r.get_url() for r in model.query])
+
+    def test_batch(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+
+        # requests are run in order, each with its own result
+        rv, json = self.client.post('/api/v1/batch', data={'requests': [
+            {'method': 'POST', 'url': customer + '/orders/',
+             'body': {'date': '2014-01-01T00:00:00Z'}},
+            {'url': customer + '/orders/'},
+            {'method': 'POST', 'url': '/api/v1/products/', 'body': {}},
+            {'url': '/api/v1/products/12345'},
+        ]})
+        self.assertTrue(rv.status_code == 200)
+        responses = json['responses']
+        self.assertTrue([r['status'] for r in responses] ==
+                        [201, 200, 400, 404])
+        order = responses[0]['headers']['Location']
+        self.assertTrue(responses[1]['body']['orders'] == [order])
+        self.assertTrue(responses[2]['body']['error'] == 'bad request')
+        rv, json = self.client.get(order)
+        self.assertTrue(rv.status_code == 200)
+
+        # in atomic mode a failed request rolls back the whole batch
+        rv, json = self.client.post('/api/v1/batch', data={
+            'atomic': True,
+            'requests': [
+                {'method': 'PUT', 'url': customer, 'body': {'name': 'bob'}},
+                {'method': 'POST', 'url': '/api/v1/products/',
+                 'body': {'name': 'prod'}},
+                {'method': 'PUT', 'url': order, 'body': {}},
+                {'method': 'DELETE', 'url': order},
+            ]})
+        self.assertTrue(rv.status_code == 200)
+        self.assertFalse(json['committed'])
+        self.assertTrue([r['status'] for r in json['responses']] ==
+                        [200, 201, 400])
+        rv, json = self.client.get(customer)
+        self.assertTrue(json['name'] == 'john')
+        rv, json = self.client.get('/api/v1/products/')
+        self.assertTrue(json['products'] == [])
+
+        # and when all the requests succeed everything is committed
+        rv, json = self.client.post('/api/v1/batch', data={
+            'atomic': True,
+            'requests': [
+                {'method': 'PUT', 'url': customer, 'body': {'name': 'bob'}},
+                {'method': 'DELETE', 'url': order},
+            ]})
+        self.assertTrue(json['committed'])
+        rv, json = self.client.get(customer)
+        self.assertTrue(json['name'] == 'bob')
+        with self.assertRaises(NotFound):
+            self.client.get(order)
+
+        # an unhandled error only fails its own request
+        get_products = self.app.view_functions['api.get_products']
+
+        def broken_get_products():
+            raise RuntimeError('broken')
+        self.app.view_functions['api.get_products'] = broken_get_products
+        try:
+            rv, json = self.client.post('/api/v1/batch', data={'requests': [
+                {'method': 'PUT', 'url': customer, 'body': {'name': 'tom'}},
+                {'url': '/api/v1/products/'},
+                {'url': customer}]})
+        finally:
+            self.app.view_functions['api.get_products'] = get_products
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([r['status'] for r in json['responses']] ==
+                        [200, 500, 200])
+        self.assertTrue(json['responses'][2]['body']['name'] == 'tom')
+
+        # invalid batches
+        with self.assertRaises(ValidationError):
+            self.client.post('/api/v1/batch', data={'foo': []})
+        with self.assertRaises(ValidationError):
+            self.client.post('/api/v1/batch', data={'requests': [
+                {'method': 'POST', 'url': '/api/v1/batch', 'body': {}}]})
+
+    def test_conditional_writes(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post(customer + '/orders/',
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        order = rv.headers['Location']
+
+        # etags of single resources are generated from their versions
+        rv, json = self.client.get(customer)
+        self.assertTrue(rv.headers['ETag'] == '"1"')
+        rv, json = self.client.put(customer, data={'name': 'susan'},
+                                   headers={'If-Match': '"1"'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(customer)
+        self.assertTrue(rv.headers['ETag'] == '"2"')
+        self.assertTrue(json['name'] == 'susan')
+
+        # writes with an old version are rejected
+        with self.assertRaises(PreconditionFailed):
+            self.client.put(customer, data={'name': 'bob'},
+                            headers={'If-Match': '"1"'})
+        with self.assertRaises(PreconditionFailed):
+            self.client.delete(order, headers={'If-Match': '"2", "3"'})
+        rv, json = self.client.delete(order, headers={'If-Match': '"1"'})
+        self.assertTrue(rv.status_code == 200)
+
+        # the API returns a 412 status code
+        client = self.app.test_client()
+        rv = client.put(customer, headers={'Authorization': self.client.auth,
+                                           'If-Match': '"1"'},
+                        data='{"name": "bob"}',
+                        content_type='application/json')
+        self.assertTrue(rv.status_code == 412)
+
+        # the version is also checked when the update is written, which
+        # catches changes made after the resource was loaded
+        c = Customer.query.get(1)
+        db.session.execute(Customer.__table__.update().values(
+            version=Customer.version + 1))
+        c.name = 'bob'
+        with self.assertRaises(StaleDataError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_changes(self):
+        rv, json = self.client.get('/api/v1/changes/')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['changes'] == [])
+        self.assertTrue(json['last_seq'] == 0)
+
+        # make some changes
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+        rv, json = self.client.post(customer + '/orders/',
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        order = rv.headers['Location']
+        rv, json = self.client.post(order + '/items/',
+                                    data={'product_url': product,
+                                          'quantity': 2})
+        item = rv.headers['Location']
+        rv, json = self.client.put(customer, data={'name': 'susan'})
+        rv, json = self.client.put(customer, data={'name': 'susan'})
+        rv, json = self.client.delete(order)
+
+        # get the changes in two pages
+        rv, json = self.client.get('/api/v1/changes/?limit=4')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([(c['url'], c['operation'])
+                         for c in json['changes']] ==
+                        [(customer, 'create'), (product, 'create'),
+                         (order, 'create'), (item, 'create')])
+        self.assertTrue(json['last_seq'] == json['changes'][-1]['seq'])
+        rv, json = self.client.get(json['next_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['changes'][0]['url'] == customer)
+        self.assertTrue(json['changes'][0]['operation'] == 'update')
+        self.assertTrue(sorted((c['url'], c['operation'])
+                               for c in json['changes'][1:]) ==
+                        [(item, 'delete'), (order, 'delete')])
+
+        # nothing new after the last change
+        rv, json = self.client.get(json['next_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['changes'] == [])
+        next_url = json['next_url']
+
+        # changes that are rolled back are not in the log
+        rv, json = self.client.post('/api/v1/batch', data={
+            'atomic': True,
+            'requests': [
+                {'method': 'PUT', 'url': customer, 'body': {'name': 'bob'}},
+                {'method': 'PUT', 'url': product, 'body': {}},
+            ]})
+        self.assertFalse(json['committed'])
+        rv, json = self.client.get(next_url)
+        self.assertTrue(json['changes'] == [])
+
+    def test_order_events(self):
+        self.app.config['EVENTS_KEEPALIVE'] = 0.01
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post(customer + '/orders/',
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        order1 = rv.headers['Location']
+
+        # resume from the start of the change log, which sends the order
+        # created above, but not the customer
+        rv = self.app.test_client().get(
+            '/api/v1/orders/events', buffered=False,
+            headers={'Authorization': self.client.auth,
+                     'Last-Event-ID': '0'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'text/event-stream')
+        stream = iter(rv.response)
+        self.assertTrue(next(stream) == ('id: 2\nevent: created\n'
+                                         'data: {"url": "' + order1 +
+                                         '"}\n\n').encode('utf-8'))
+        self.assertTrue(next(stream) == b': keepalive\n\n')
+
+        # new changes are pushed as they are committed
+        rv2, json = self.client.post(customer + '/orders/',
+                                     data={'date': '2014-01-01T00:00:00Z'})
+        order2 = rv2.headers['Location']
+        rv2, json = self.client.put(customer, data={'name': 'susan'})
+        rv2, json = self.client.delete(order1)
+        events = [next(stream), next(stream)]
+        self.assertIn(('event: created\ndata: {"url": "' + order2 +
+                       '"}').encode('utf-8'), events[0])
+        self.assertIn(('event: deleted\ndata: {"url": "' + order1 +
+                       '"}').encode('utf-8'), events[1])
+        rv.close()
+        self.assertTrue(len(hub.subscriptions) == 0)
+
+        # the position can also be given in the query string, for clients
+        # that cannot send headers
+        last_id = events[1].decode('utf-8').split('\n')[0][4:]
+        rv = self.app.test_client().get(
+            '/api/v1/orders/events?last_event_id=' + last_id,
+            buffered=False, headers={'Authorization': self.client.auth})
+        stream = iter(rv.response)
+        self.assertTrue(next(stream) == b': keepalive\n\n')
+        rv2, json = self.client.post(customer + '/orders/',
+                                     data={'date': '2014-01-01T00:00:00Z'})
+        order3 = rv2.headers['Location']
+        self.assertIn(('event: created\ndata: {"url": "' + order3 +
+                       '"}').encode('utf-8'), next(stream))
+        rv.close()
+        self.assertTrue(len(hub.subscriptions) == 0)
+
+        # event streams never end, so they cannot be part of a batch
+        with self.assertRaises(ValidationError):
+            self.client.post('/api/v1/batch', data={
+                'requests': [{'url': '/api/v1/orders/events'}]})
+        self.assertTrue(len(hub.subscriptions) == 0)
+
+    def test_bulk_delete(self):
+        self.app.config['BULK_DELETE_CHUNK'] = 2
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+        orders = []
+        for month in range(1, 6):
+            rv, json = self.client.post(
+                customer + '/orders/',
+                data={'date': '2014-{0:02d}-01T00:00:00Z'.format(month)})
+            orders.append(rv.headers['Location'])
+            for i in range(3):
+                rv, json = self.client.post(orders[-1] + '/items/',
+                                            data={'product_url': product,
+                                                  'quantity': i + 1})
+        rv, json = self.client.get('/api/v1/changes/?limit=1000')
+        last_seq = json['last_seq']
+
+        # delete the orders before April, in chunks of two orders, with
+        # four statements for each chunk however many items it has
+        db.session.remove()
+        with self.assertMaxQueries(10):
+            rv, json = self.client.delete('/api/v1/orders/'
+                                          '?before=2014-04-01T00:00:00Z')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['deleted'] == 3)
+        statements = self.client.queries[-1]
+        self.assertTrue(len([s for s in statements
+                             if s.startswith('DELETE')]) == 2)
+        rv, json = self.client.get('/api/v1/orders/')
+        self.assertTrue(json['orders'] == orders[3:])
+        self.assertTrue(Item.query.count() == 6)
+
+        # the deleted orders and items are in the change log
+        rv, json = self.client.get('/api/v1/changes/?after={0}'.format(
+            last_seq))
+        self.assertTrue(len(json['changes']) == 12)
+        self.assertTrue(all(c['operation'] == 'delete'
+                            for c in json['changes']))
+
+        # a single order also deletes its items in the database
+        db.session.remove()
+        rv, json = self.client.delete(orders[3])
+        self.assertTrue(rv.status_code == 200)
+        self.assertFalse(any('FROM items' in s and s.startswith('SELECT')
+                             for s in self.client.queries[-1]))
+        self.assertTrue(Item.query.count() == 3)
+
+        with self.assertRaises(ValidationError):
+            self.client.delete('/api/v1/orders/')
+        with self.assertRaises(ValidationError):
+            self.client.delete('/api/v1/orders/?before=foo')
+
+    def test_archive(self):
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        customer = rv.headers['Location']
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+        orders = []
+        for date in ['2014-01-01T00:00:00Z',
+                     datetime.utcnow().isoformat() + 'Z']:
+            rv, json = self.client.post(customer + '/orders/',
+                                        data={'date': date})
+            orders.append(rv.headers['Location'])
+            rv, json = self.client.post(orders[-1] + '/items/',
+                                        data={'product_url': product,
+                                              'quantity': 2})
+        item = rv.headers['Location']
+        urls = [orders[0], orders[0] + '/items/?expanded=1',
+                customer + '/orders/?expanded=1']
+        before = [self.client.get(url)[1] for url in urls]
+        rv, json = self.client.get(orders[0] + '/items/')
+        old_item = json['items'][0]
+
+        # only the old order is archived
+        self.assertTrue(archive_orders(90) == 1)
+        self.assertTrue(Order.query.count() == 1)
+        self.assertTrue(Item.query.count() == 1)
+        self.assertTrue(ArchivedOrder.query.count() == 1)
+        self.assertTrue(ArchivedItem.query.count() == 1)
+        self.assertTrue(archive_orders(90) == 0)
+
+        # archived orders and items are still available, with one more
+        # query than usual to look up an order in the archive, and none
+        # for a customer's orders, which come from both tables at once
+        after = []
+        for url, budget in zip(urls, [4, 4, 3]):
+            db.session.remove()
+            with self.assertMaxQueries(budget):
+                after.append(self.client.get(url)[1])
+        self.assertTrue(before == after)
+        rv, json = self.client.get(old_item)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['order_url'] == orders[0])
+        rv, json = self.client.get(item)
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(customer + '/orders/')
+        self.assertTrue(sorted(json['orders']) == orders)
+
+        # the orders collection only has the orders that are not archived,
+        # and archived orders cannot be modified
+        rv, json = self.client.get('/api/v1/orders/')
+        self.assertTrue(json['orders'] == orders[1:])
+        with self.assertRaises(NotFound):
+            self.client.put(orders[0], data={'date': '2014-02-01T00:00:00Z'})
+
+    def test_sharding(self):
+        self.stop_app()
+        self.start_app('testing_sharded')
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+
+        # customers are spread across the three shards, and their orders
+        # and items are stored in the same shard
+        customers = []
+        orders = []
+        items = []
+        for i in range(3):
+            rv, json = self.client.post('/api/v1/customers/',
+                                        data={'name': 'customer' + str(i)})
+            customers.append(rv.headers['Location'])
+            rv, json = self.client.post(customers[-1] + '/orders/',
+                                        data={'date': '2014-01-01T00:00:00Z'})
+            orders.append(rv.headers['Location'])
+            rv, json = self.client.post(orders[-1] + '/items/',
+                                        data={'product_url': product,
+                                              'quantity': 2})
+            items.append(rv.headers['Location'])
+        for urls in [customers, orders, items]:
+            ids = [int(url.split('/')[-1]) for url in urls]
+            self.assertTrue([shard_for_id(id) for id in ids] == [0, 1, 2])
+        for shard_id in range(3):
+            engine = db.get_engine(self.app, shard_bind(shard_id))
+            for table in ['customers', 'orders', 'items', 'products']:
+                self.assertTrue(engine.execute(
+                    'select count(*) from ' + table).scalar() == 1)
+
+        # resources are found in their shard
+        rv, json = self.client.get(customers[2])
+        self.assertTrue(json['name'] == 'customer2')
+        rv, json = self.client.get(orders[2])
+        self.assertTrue(json['customer_url'] == customers[2])
+        rv, json = self.client.get(items[2])
+        self.assertTrue(json['order_url'] == orders[2])
+        self.assertTrue(json['product_url'] == product)
+        rv, json = self.client.get(customers[1] + '/orders/')
+        self.assertTrue(json['orders'] == orders[1:2])
+        rv, json = self.client.get(orders[1] + '/items/?expanded=1')
+        self.assertTrue(json['items'][0]['self_url'] == items[1])
+        rv, json = self.client.put(items[1], data={'product_url': product,
+                                                   'quantity': 3})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(items[1])
+        self.assertTrue(json['quantity'] == 3)
+        with self.assertRaises(NotFound):
+            self.client.get('/api/v1/orders/' + str(5 << 40))
+
+        # collections are gathered from all the shards, and a page only
+        # queries the rows of the shards that hold them
+        rv, json = self.client.get('/api/v1/orders/?per_page=2')
+        self.assertTrue(json['orders'] == orders[:2])
+        self.assertTrue(json['pages']['total'] == 3)
+        with self.assertMaxQueries(5):
+            rv, json = self.client.get(json['pages']['next_url'])
+        self.assertTrue(json['orders'] == orders[2:])
+        self.assertTrue(len([s for s in self.client.queries[-1]
+                             if 'count' not in s and 'FROM orders' in s])
+                        == 1)
+
+        # other queries are joined in the order of the shards, with their
+        # limits and offsets applied across them
+        ids = [int(url.split('/')[-1]) for url in orders]
+        self.assertTrue([o.id for o in Order.query.order_by(Order.id)] ==
+                        ids)
+        self.assertTrue(Order.query.order_by(Order.id).first().id == ids[0])
+        self.assertTrue([o.id for o in Order.query.offset(1).limit(1)] ==
+                        ids[1:2])
+        self.assertTrue([id for id, in Order.query.with_entities(
+            Order.id).offset(2)] == ids[2:])
+        with self.assertRaises(InvalidRequestError):
+            Order.query.order_by(Order.date).all()
+        with self.assertRaises(InvalidRequestError):
+            Order.query.order_by(Order.id.desc()).first()
+        rv, json = self.client.get('/api/v1/customers/?expanded=1')
+        self.assertTrue([c['self_url'] for c in json['customers']] ==
+                        customers)
+
+        # deletes are cascaded and logged in every shard
+        rv, json = self.client.delete(orders[2])
+        self.assertTrue(rv.status_code == 200)
+        with self.assertRaises(NotFound):
+            self.client.get(items[2])
+        rv, json = self.client.get('/api/v1/changes/?after=0')
+        self.assertTrue([(c['url'], c['operation'])
+                         for c in json['changes'][-2:]] ==
+                        [(items[2], 'delete'), (orders[2], 'delete')])
+
+        # old orders are archived and deleted within their shard
+        self.assertTrue(archive_orders(90) == 2)
+        rv, json = self.client.get(items[1])
+        self.assertTrue(json['order_url'] == orders[1])
+        rv, json = self.client.get(customers[1] + '/orders/')
+        self.assertTrue(json['orders'] == orders[1:2])
+        rv, json = self.client.post(customers[2] + '/orders/',
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        rv, json = self.client.delete('/api/v1/orders/?before=2015-01-01')
+        self.assertTrue(json['deleted'] == 1)
+        rv, json = self.client.get('/api/v1/orders/')
+        self.assertTrue(json['orders'] == [])
+
+    def test_rate_limit(self):
+        self.app.config['RATE_LIMIT_ENABLED'] = True
+        self.app.config['RATE_LIMITS'] = {'api': (30, 60),
+                                          'api.get_customer': (2, 60)}
+
+        # single requests cost one request, and expanded pages one request
+        # per resource
+        rv, json = self.client.get('/api/v1/customers/')
+        self.assertTrue(rv.headers['X-RateLimit-Limit'] == '30')
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '29')
+        rv, json = self.client.get('/api/v1/customers/?expanded=1&per_page=10')
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '19')
+        rv, json = self.client.get('/api/v1/customers/?expanded=1')
+        self.assertTrue(rv.status_code == 429)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '19')
+        self.assertTrue(rv.headers['Retry-After'] == '12')
+
+        # routes with their own limits are counted separately
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '18')
+        location = rv.headers['Location']
+        rv, json = self.client.get(location)
+        self.assertTrue(rv.headers['X-RateLimit-Limit'] == '2')
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '1')
+        rv, json = self.client.get(location)
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(location)
+        self.assertTrue(rv.status_code == 429)
+
+        # each user has its own budget, and the requests in a batch are
+        # charged as if they were sent on their own
+        u = User(username='susan')
+        u.set_password('dog')
+        db.session.add(u)
+        db.session.commit()
+        client = TestClient(self.app, u.generate_auth_token(), '')
+        rv, json = client.post('/api/v1/batch', data={
+            'requests': [{'url': '/api/v1/customers/'}] * 5})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '25')
+        rv, json = client.post('/api/v1/batch', data={
+            'requests': [{'url': location}] * 3 +
+            [{'url': '/api/v1/customers/?expanded=1&per_page=10'}]})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([r['status'] for r in json['responses']] ==
+                        [200, 200, 429, 200])
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '15')
+
+    def test_rate_limit_ip(self):
+        self.app.config['RATE_LIMIT_ENABLED'] = True
+        self.app.config['RATE_LIMITS'] = {'api:ip': (2, 60)}
+
+        # requests that fail authentication are limited by IP address
+        client = TestClient(self.app, 'bad-token', '')
+        rv, json = client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 401)
+        self.assertTrue(rv.headers['X-RateLimit-Limit'] == '2')
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '1')
+        rv, json = client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 401)
+        for i in range(3):
+            rv, json = client.get('/api/v1/customers/')
+            self.assertTrue(rv.status_code == 429)
+            self.assertTrue(rv.headers['Retry-After'] == '30')
+
+        # valid users sending requests from the same address are not
+        self.app.config['RATE_LIMITS']['api'] = (30, 60)
+        rv, json = self.client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Limit'] == '30')
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '29')
+
+    def test_product_cache(self):
+        rv, json = self.client.post('/api/v1/products/',
+                                    data={'name': 'prod'})
+        product = rv.headers['Location']
+        product_id = int(product.split('/')[-1])
+        rv, json = self.client.post('/api/v1/customers/',
+                                    data={'name': 'john'})
+        rv, json = self.client.post(rv.headers['Location'] + '/orders/',
+                                    data={'date': '2014-01-01T00:00:00Z'})
+        order = rv.headers['Location']
+
+        # only the first item loads the product, and rendering items does
+        # not need it
+        for i in range(3):
+            rv, json = self.client.post(order + '/items/',
+                                        data={'product_url': product,
+                                              'quantity': 2})
+            self.assertTrue(rv.status_code == 201)
+            queries = [q for q in self.client.queries[-1]
+                       if 'FROM products' in q]
+            self.assertTrue(len(queries) == (1 if i == 0 else 0))
+        rv, json = self.client.get(rv.headers['Location'])
+        self.assertTrue(json['product_url'] == product)
+        self.assertFalse(any('FROM products' in q
+                             for q in self.client.queries[-1]))
+        with self.assertRaises(ValidationError):
+            self.client.post(order + '/items/',
+                             data={'product_url': product + '0',
+                                   'quantity': 2})
+
+        # writes invalidate the cached product
+        self.assertTrue(product_cache.get(product_id).name == 'prod')
+        rv, json = self.client.put(product, data={'name': 'new'})
+        self.assertTrue(product_id not in product_cache.rows)
+        self.assertTrue(product_cache.get(product_id).name == 'new')
+
+        # changes made by other processes are seen once the ttl expires
+        self.app.config['PRODUCT_CACHE_TTL'] = 0.05
+        product_cache.invalidate()
+        product_cache.get(product_id)
+        db.engine.execute(Product.__table__.update().values(name='other'))
+        self.assertTrue(product_cache.get(product_id).name == 'new')
+        time.sleep(0.1)
+        self.assertTrue(product_cache.get(product_id).name == 'other')
+
+    def test_metrics(self):
+        # send a couple of requests to get some measurements
+        rv, json = self.client.get('/api/v1/customers/')
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get('/api/v1/customers/?expanded=1')
+        self.assertTrue(rv.status_code == 200)
+
+        # metrics are returned in text format, not JSON
+        rv = self.app.test_client().get('/metrics')
+        self.assertTrue(rv.status_code == 200)
+        metrics = rv.data.decode('utf-8')
+        self.assertIn('# TYPE http_requests_total counter', metrics)
+        self.assertIn('http_requests_total{endpoint="api.get_customers",'
+                      'method="GET",status="200"}', metrics)
+        self.assertIn('http_request_duration_seconds_count{'
+                      'endpoint="api.get_customers"}', metrics)
+        self.assertIn('sql_statements_per_request_bucket{'
+                      'endpoint="api.get_customers",le="+Inf"}', metrics)
+        for decorator in ['json', 'paginate', 'etag']:
+            self.assertIn('decorator_duration_seconds_count{decorator="' +
+                          decorator + '"}', metrics)
+
+    def test_query_budgets(self):
+        # create three customers with an order each, and three products
+        # that are all added to the last order, so that lazy loads in
+        # expanded collections show up as extra queries
+        products = []
+        for i in range(3):
+            rv, json = self.client.post('/api/v1/customers/',
+                                        data={'name': 'customer' + str(i)})
+            customer = rv.headers['Location']
+            rv, json = self.client.post(customer + '/orders/',
+                                        data={'date': '2014-01-01T00:00:00Z'})
+            order = rv.headers['Location']
+            rv, json = self.client.post('/api/v1/products/',
+                                        data={'name': 'product' + str(i)})
+            products.append(rv.headers['Location'])
+        for i in range(3):
+            rv, json = self.client.post(order + '/items/',
+                                        data={'product_url': products[i],
+                                              'quantity': i + 1})
+        item = rv.headers['Location']
+        product = products[-1]
+
+        # maximum number of queries for each endpoint, including the one
+        # that loads the authenticated user, and for writes the one that
+        # adds to the change log
+        budgets = [
+            (2, 'GET', '/api/v1/customers/', None),
+            (2, 'GET', '/api/v1/customers/?expanded=1', None),
+            (2, 'GET', customer, None),
+            (4, 'PUT', customer, {'name': 'john'}),
+            (4, 'POST', '/api/v1/customers/', {'name': 'susan'}),
+            (3, 'GET', customer + '/orders/', None),
+            (3, 'GET', customer + '/orders/?expanded=1', None),
+            (2, 'GET', '/api/v1/products/', None),
+            (2, 'GET', '/api/v1/products/?expanded=1', None),
+            (2, 'GET', product, None),
+            (4, 'PUT', product, {'name': 'prod'}),
+            (4, 'POST', '/api/v1/products/', {'name': 'prod'}),
+            (2, 'GET', '/api/v1/orders/', None),
+            (2, 'GET', '/api/v1/orders/?expanded=1', None),
+            (3, 'GET', order, None),
+            (4, 'PUT', order, {'date': '2014-02-02T00:00:00Z'}),
+            (5, 'POST', customer + '/orders/',
+             {'date': '2014-01-01T00:00:00Z'}),
+            (3, 'GET', order + '/items/', None),
+            (3, 'GET', order + '/items/?expanded=1', None),
+            (3, 'GET', item, None),
+            (5, 'PUT', item, {'product_url': product, 'quantity': 5}),
+            (5, 'POST', order + '/items/',
+             {'product_url': product, 'quantity': 1}),
+            (2, 'GET', '/api/v1/changes/', None),
+            (2, 'GET', '/api/v1/changes/?after=5&limit=5', None),
+            (5, 'POST', '/api/v1/batch', {'requests': [
+                {'url': customer}, {'url': product}, {'url': item}]}),
+            (4, 'DELETE', item, None),
+            (5, 'DELETE', order, None),
+        ]
+        for budget, method, url, data in budgets:
+            # start each request with an empty session, as it would be
+            # outside of the tests
+            db.session.remove()
+            with self.assertMaxQueries(budget):
+                rv, json = self.client.send(url, method, data)
+            self.assertTrue(rv.status_code in [200, 201])